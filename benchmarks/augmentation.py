@@ -0,0 +1,39 @@
+import argparse
+import os
+
+import numpy as np
+
+from benchmarks.timing import images_per_sec
+from model.augmentation import ParallelAugmenter, augmentation
+
+
+def serial(augmenter):
+    return lambda x: np.array([augmenter(image=img.astype(np.uint8))['image'] for img in x])
+
+
+def run(worker_counts, input_shape=(64, 64, 3), batch_size=64, repeats=10, seed=42):
+    x = np.random.default_rng(seed).integers(0, 256, (batch_size, *input_shape), dtype=np.uint8)
+    results = [{'workers': 0, 'images/sec': images_per_sec(serial(augmentation()), x, repeats)}]
+    for n_workers in worker_counts:
+        augmenter = ParallelAugmenter(n_workers)
+        results.append({'workers': n_workers, 'images/sec': images_per_sec(augmenter, x, repeats)})
+        augmenter.close()
+    return results
+
+
+def print_results(results):
+    base = results[0]['images/sec']
+    print(f"{'workers': <8}{'images/sec': >12}{'speedup': >10}")
+    for r in results:
+        print(f"{r['workers']: <8}{r['images/sec']: >12.0f}{r['images/sec'] / base: >10.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='augmentation throughput as the worker count scales')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[w for w in (1, 2, 4, 8, 16, 32, 64) if w <= os.cpu_count()])
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+    print_results(run(args.workers, (args.size, args.size, 3), args.batch_size, args.repeats))
@@ -0,0 +1,47 @@
+import argparse
+
+import numpy as np
+
+from benchmarks.timing import images_per_sec
+from enums import PermSchemas
+from permutation.BlockShuffle import BlockScramble, doScramble
+
+SCHEMES = [PermSchemas.BS_2, PermSchemas.BS_4, PermSchemas.BS_8]
+
+
+def run(sub_input_shape=(32, 32, 3), batch_size=64, repeats=50, seed=42):
+    x = np.random.default_rng(seed).integers(0, 256, (batch_size, *sub_input_shape), dtype=np.uint8)
+    x_float = x / 255.0
+    out = np.empty_like(x)
+    results = []
+    for scheme in SCHEMES:
+        bs = BlockScramble((*scheme.value, sub_input_shape[-1]), seed)
+        assert np.array_equal(bs.ScrambleUint8(x), doScramble(x, bs.key, bs.rev, bs.blockSize))
+        results.append({
+            'scheme': scheme.name,
+            'doScramble': images_per_sec(lambda b: doScramble(b, bs.key, bs.rev, bs.blockSize), x, repeats),
+            'fused_uint8': images_per_sec(lambda b: bs.ScrambleUint8(b, out=out), x, repeats),
+            'legacy_float': images_per_sec(
+                lambda b: doScramble((b * 255).astype(np.uint8), bs.key, bs.rev, bs.blockSize).astype('float32') / 255.0,
+                x_float, repeats
+            ),
+            'fused_float': images_per_sec(bs.Scramble, x_float, repeats),
+        })
+    return results
+
+
+def print_results(results):
+    columns = ['doScramble', 'fused_uint8', 'legacy_float', 'fused_float']
+    print(f"{'scheme': <8}" + ''.join(f'{c: >14}' for c in columns) + '   (images/sec)')
+    for r in results:
+        print(f"{r['scheme']: <8}" + ''.join(f'{r[c]: >14.0f}' for c in columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='BlockScramble throughput, reference vs fused kernel')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--size', type=int, default=32, help='sub-input height and width')
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+    print_results(run((args.size, args.size, args.channels), args.batch_size, args.repeats))
@@ -0,0 +1,190 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+from io import StringIO
+from itertools import product
+
+import numpy as np
+
+from benchmarks.timing import images_per_sec
+from datasets import to_categorical_n_classes
+from enums import Overlap, PermSchemas
+from model.augmentation import augmentation
+from permutation.BlockShuffle import doScramble
+from permutation.permutations import generate_permutations, PatchExtractor, permute
+
+HISTORY_PATH = 'benchmarks/results/history.json'
+BASELINE_PATH = 'benchmarks/results/baseline.json'
+REGRESSION_THRESHOLD = 0.1  # relative drop in images/sec, or growth in bytes, reported as a regression
+MIN_TIME = 0.2  # seconds each case is repeated for
+STAGES = ['generate_patches', 'generate_patches_uint8', 'permute', 'doScramble', 'augment', 'to_categorical_n_classes']
+WINDOW_STAGES = STAGES[:4]  # depend on the scheme, overlap and grid, the others only on the batch
+
+
+def bytes_allocated(fn, x):
+    # peak of the allocations traced during one call, numpy buffers included, TF tensors are not
+    tracemalloc.start()
+    fn(x)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def crops(x, permutations, sub_input_shape):
+    sr, sc, _ = sub_input_shape
+    return [x[:, int(r * sr):int(r * sr) + sr, int(c * sc):int(c * sc) + sc] for r, c in permutations]
+
+
+def window_stage(stage, permutations, sub_input_shape):
+    # the stage as a function of a uint8 batch, None when the scheme has no such path
+    extractor = PatchExtractor(permutations, sub_input_shape)
+    if stage == 'generate_patches':
+        return lambda x: extractor(x / 255.0)
+    if stage == 'generate_patches_uint8':
+        return extractor.extract
+    if stage == 'permute':  # the per-window path replaced by PatchExtractor, image by image for pixel shuffles
+        if extractor.scrambled:
+            return lambda x: [
+                permute(window, perm[0])
+                for window, perm in zip(crops(x / 255.0, permutations, sub_input_shape), permutations.values())
+            ]
+        return lambda x: [
+            np.array([permute(img, perm) for img in window])
+            for window, perm in zip(crops(x / 255.0, permutations, sub_input_shape), permutations.values())
+        ]
+    if stage == 'doScramble' and extractor.scrambled:
+        return lambda x: [
+            doScramble(window, perm[0].key, perm[0].rev, perm[0].blockSize)
+            for window, perm in zip(crops(x, permutations, sub_input_shape), permutations.values())
+        ]
+    return None
+
+
+def batch_stage(stage):
+    if stage == 'augment':
+        augmenter = augmentation()
+        return lambda x: np.array([augmenter(image=img)['image'] for img in x])
+    if stage == 'to_categorical_n_classes':
+        def fn(x):
+            y = np.arange(len(x)) % 10
+            with redirect_stdout(StringIO()):
+                return to_categorical_n_classes(x, y, x, y, upscale=True)
+        return fn
+    return None
+
+
+def fits(scheme, sub_input_shape):
+    if scheme in [PermSchemas.NAIVE, PermSchemas.IDENTITY]:
+        return True
+    return sub_input_shape[0] % scheme.value[0] == 0 and sub_input_shape[1] % scheme.value[1] == 0
+
+
+def run(stages=STAGES, schemes=tuple(PermSchemas), overlaps=tuple(Overlap), grids=(1, 2), batch_sizes=(32, 128),
+        input_shape=(64, 64, 3), min_time=MIN_TIME, seed=42):
+    results = {}
+
+    def measure(name, fn, x):
+        results[name] = {'images/sec': images_per_sec(fn, x, min_time=min_time), 'bytes': bytes_allocated(fn, x)}
+        print(f"{name: <64}{results[name]['images/sec']: >12.0f}{results[name]['bytes']: >14}", file=sys.stderr)
+
+    for batch_size in batch_sizes:
+        x = np.random.default_rng(seed).integers(0, 256, (batch_size, *input_shape), dtype=np.uint8)
+        for stage in stages:
+            if stage not in WINDOW_STAGES:
+                measure(f'{stage}/batch={batch_size}', batch_stage(stage), x)
+                continue
+            for scheme, overlap, grid in product(schemes, overlaps, grids):
+                sub_input_shape = (input_shape[0] // grid, input_shape[1] // grid, input_shape[2])
+                if not fits(scheme, sub_input_shape):
+                    continue
+                key_seed = None if scheme == PermSchemas.IDENTITY else seed
+                permutations = generate_permutations(key_seed, (grid, grid), sub_input_shape, overlap, scheme)
+                fn = window_stage(stage, permutations, sub_input_shape)
+                if fn is not None:
+                    name = f'{stage}/{scheme.name}/{overlap.name}/grid={grid}/batch={batch_size}'
+                    measure(name, fn, x)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def load_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def save_json(path, obj):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(f'{path}.tmp', path)
+
+
+def append_history(results, path=HISTORY_PATH):
+    history = load_json(path, [])
+    history.append({'time': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(), 'results': results})
+    save_json(path, history)
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    # cases slower or allocating more than the baseline by more than threshold, cases missing on either side skipped
+    regressions = []
+    for name, r in results.items():
+        b = baseline.get(name)
+        if b is None:
+            continue
+        speed = r['images/sec'] / b['images/sec']
+        memory = r['bytes'] / max(b['bytes'], 1)
+        if speed < 1 - threshold or memory > 1 + threshold:
+            regressions.append((name, speed, memory))
+    return regressions
+
+
+def print_regressions(regressions, threshold):
+    if not regressions:
+        print(f"No regressions beyond {threshold:.0%}")
+        return
+    print(f"{len(regressions)} regressions beyond {threshold:.0%}:")
+    print(f"{'case': <64}{'speed': >8}{'memory': >8}")
+    for name, speed, memory in regressions:
+        print(f"{name: <64}{speed: >8.2f}{memory: >8.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='throughput and allocations of the permutation and data pipeline')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--schemes', nargs='+', default=[s.name for s in PermSchemas], choices=PermSchemas.__members__)
+    parser.add_argument('--overlaps', nargs='+', default=[o.name for o in Overlap], choices=Overlap.__members__)
+    parser.add_argument('--grids', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 128])
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--min-time', type=float, default=MIN_TIME)
+    parser.add_argument('--history', default=HISTORY_PATH)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+    results = run(args.stages, [PermSchemas[s] for s in args.schemes], [Overlap[o] for o in args.overlaps],
+                  args.grids, args.batch_sizes, (args.size, args.size, args.channels), args.min_time)
+    append_history(results, args.history)
+    if args.save_baseline:
+        save_json(args.baseline, results)
+        print(f"Saved baseline {args.baseline}")
+    else:
+        regressions = compare(results, load_json(args.baseline, {}), args.threshold)
+        print_regressions(regressions, args.threshold)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,48 @@
+import argparse
+import os
+
+import numpy as np
+
+from benchmarks.timing import images_per_sec
+from datasets import reshape, resize_images
+
+
+def run(thread_counts, input_shape=(32, 32, 3), shape=(64, 64), n_images=2048, repeats=3, seed=42):
+    x = np.random.default_rng(seed).integers(0, 256, (n_images, *input_shape), dtype=np.uint8)
+    reference = np.array([reshape(img, shape) for img in x])
+    assert np.array_equal(resize_images(x, shape, backend='tf'), reference)
+    assert np.array_equal(resize_images(x, shape, backend='cv2'), reference)
+    results = [
+        {'backend': 'per-image', 'threads': 1,
+         'images/sec': images_per_sec(lambda b: np.array([reshape(img, shape) for img in b]), x, repeats)},
+        {'backend': 'tf', 'threads': os.cpu_count(),
+         'images/sec': images_per_sec(lambda b: resize_images(b, shape, backend='tf'), x, repeats)},
+    ]
+    for n_threads in thread_counts:
+        results.append({
+            'backend': 'cv2', 'threads': n_threads,
+            'images/sec': images_per_sec(
+                lambda b: resize_images(b, shape, backend='cv2', chunk=256, n_threads=n_threads), x, repeats
+            ),
+        })
+    return results
+
+
+def print_results(results):
+    base = results[0]['images/sec']
+    print(f"{'backend': <10}{'threads': >8}{'images/sec': >12}{'speedup': >10}")
+    for r in results:
+        print(f"{r['backend']: <10}{r['threads']: >8}{r['images/sec']: >12.0f}{r['images/sec'] / base: >10.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='upscaling throughput, per-image TF calls vs batched backends')
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=[t for t in (1, 2, 4, 8, 16, 32, 64) if t <= os.cpu_count()])
+    parser.add_argument('--size', type=int, default=32)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--n-images', type=int, default=2048)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    print_results(run(args.threads, (args.size, args.size, args.channels), n_images=args.n_images,
+                      repeats=args.repeats))
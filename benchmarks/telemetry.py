@@ -0,0 +1,87 @@
+import argparse
+import os
+import tempfile
+import time
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # suppress logging
+import numpy as np
+from tensorflow.keras import Sequential
+from tensorflow.keras.callbacks import Callback
+from tensorflow.keras.layers import Conv2D, Dense, GlobalAveragePooling2D, Input
+
+from model.train_configs import telemetry
+
+MODES = ['none', 'lean', 'full']
+
+
+class EpochTimer(Callback):
+    # wall time of each epoch, the telemetry callbacks of the previous epoch end included
+    def __init__(self):
+        super().__init__()
+        self.times = []
+        self.last = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        now = time.perf_counter()
+        if self.last is not None:
+            self.times[-1] += now - self.last
+        self.last = now
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.times.append(time.perf_counter() - self.last)
+        self.last = time.perf_counter()
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def build_model(input_shape, n_classes, filters):
+    model = Sequential([
+        Input(input_shape),
+        Conv2D(filters, 3, activation='relu'),
+        Conv2D(filters, 3, activation='relu'),
+        GlobalAveragePooling2D(),
+        Dense(n_classes, activation='softmax'),
+    ])
+    model.compile('adam', 'categorical_crossentropy', metrics=['accuracy'])
+    return model
+
+
+def run(modes=MODES, epochs=20, input_shape=(32, 32, 3), n_images=256, filters=32, seed=42):
+    rng = np.random.default_rng(seed)
+    x = rng.random((n_images, *input_shape), dtype=np.float32)
+    y = np.eye(10)[rng.integers(0, 10, n_images)]
+    results = []
+    for mode in modes:
+        with tempfile.TemporaryDirectory() as info_dir:
+            timer = EpochTimer()
+            cbs = [] if mode == 'none' else telemetry(info_dir, 'benchmark', mode)
+            model = build_model(input_shape, 10, filters)
+            start = time.perf_counter()
+            model.fit(x, y, validation_data=(x, y), epochs=epochs, verbose=0, callbacks=[timer] + cbs)
+            results.append({
+                'mode': mode,
+                'epoch_ms': 1000 * np.median(timer.times[1:]),  # the first epoch traces the train step
+                'model_s': time.perf_counter() - start,  # the whole fit, end of training plots included
+                'bytes': dir_size(info_dir),
+            })
+    return results
+
+
+def print_results(results):
+    base = results[0]
+    print(f"{'mode': <8}{'epoch ms': >10}{'overhead ms': >13}{'model s': >9}{'overhead s': >12}{'log bytes': >12}")
+    for r in results:
+        print(f"{r['mode']: <8}{r['epoch_ms']: >10.1f}{r['epoch_ms'] - base['epoch_ms']: >13.1f}"
+              f"{r['model_s']: >9.2f}{r['model_s'] - base['model_s']: >12.2f}{r['bytes']: >12}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='per-epoch and per-model overhead and log size of the telemetry modes')
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES)
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--n-images', type=int, default=256)
+    parser.add_argument('--filters', type=int, default=32)
+    args = parser.parse_args()
+    print_results(run(args.modes, args.epochs, n_images=args.n_images, filters=args.filters))
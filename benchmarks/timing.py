@@ -0,0 +1,12 @@
+import time
+
+
+def images_per_sec(fn, x, repeats=1, min_time=0.0):
+    # after a warm-up call (tables, traced kernels, started workers), at least repeats calls over at least min_time
+    fn(x)
+    calls = 0
+    start = time.perf_counter()
+    while calls < repeats or time.perf_counter() - start < min_time:
+        fn(x)
+        calls += 1
+    return calls * len(x) / (time.perf_counter() - start)
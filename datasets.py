@@ -1,18 +1,64 @@
+import hashlib
+import json
+import os
+import pathlib
+import shutil
 import string
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, exists
 
+import cv2
 import numpy as np
 import tensorflow as tf
 import tensorflow_datasets as tfds
 from keras.datasets import cifar10, fashion_mnist, mnist, cifar100
 from keras.utils.np_utils import to_categorical
 
-
-def convert_tfds_to_numpy(ds):
-    x = np.asarray(list(map(lambda v: v[0], tfds.as_numpy(ds))))
-    y = np.asarray(list(map(lambda v: v[1], tfds.as_numpy(ds))))
+DATA_CACHE_DIR = 'cache/datasets'
+DATA_CACHE_VERSION = 1  # bump when the preprocessing of any dataset changes
+RESIZE_BACKEND = 'tf'  # 'tf' or 'cv2', a thread pool of per-image cv2 resizes
+RESIZE_CHUNK = 1024  # images resized per call
+TFDS_BATCH = 1024  # examples per batch when converting a TFDS split
+UPSCALED = ['mnist', 'fashion_mnist', 'cifar10', 'cifar100', 'emnist-letters']
+
+
+def convert_tfds_to_numpy(ds, batch_size=TFDS_BATCH):
+    # one pass over the pipeline, batches are written straight into preallocated arrays
+    n = int(ds.cardinality())
+    if n < 0:  # unknown length, count it without decoding the images
+        n = int(ds.map(lambda x, y: 0).reduce(0, lambda count, _: count + 1))
+    x = y = None
+    start = 0
+    for xb, yb in tfds.as_numpy(ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)):
+        if x is None:
+            x = np.empty((n, *xb.shape[1:]), dtype=xb.dtype)
+            y = np.empty((n, *yb.shape[1:]), dtype=yb.dtype)
+        x[start:start + len(xb)] = xb
+        y[start:start + len(yb)] = yb
+        start += len(xb)
     return x, y
 
 
+class FoldView:
+    # rows `indices` of `base` without copying them, indexing gathers from the base
+    def __init__(self, base, indices):
+        self.base = base
+        self.indices = np.asarray(indices, dtype=np.intp)
+        self.shape = (len(self.indices), *base.shape[1:])
+        self.dtype = base.dtype
+        self.ndim = base.ndim
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, item):
+        return self.base[self.indices[item]]
+
+    def __array__(self, dtype=None, copy=None):
+        x = self.base[self.indices]
+        return x if dtype is None else x.astype(dtype, copy=False)
+
+
 def to_categorical_n_classes(x_train, y_train, x_test, y_test, upscale=False):
     classes = np.unique(y_train)
     n_classes = len(classes)
@@ -21,8 +67,8 @@ def to_categorical_n_classes(x_train, y_train, x_test, y_test, upscale=False):
 
     if upscale:
         shape = (64, 64)
-        x_train = np.array([reshape(img, shape) for img in x_train])
-        x_test = np.array([reshape(img, shape) for img in x_test])
+        x_train = resize_images(x_train, shape)
+        x_test = resize_images(x_test, shape)
 
     if len(x_train.shape) == 3:
         x_train = np.expand_dims(x_train, axis=-1)
@@ -37,8 +83,71 @@ def reshape(img, shape):
     return tf.cast(tf.image.resize(img, shape), tf.uint8)
 
 
-def load_data(dataset):
-    upscale = dataset in ['mnist', 'fashion_mnist', 'cifar10', 'cifar100', 'emnist-letters']
+def resize_images(x, shape, backend=RESIZE_BACKEND, chunk=RESIZE_CHUNK, n_threads=None):
+    # bilinear resize of chunks of images, both backends give the bytes of reshape() image by image
+    if x.ndim == 3:  # grayscale images get their channel axis here
+        x = x[..., np.newaxis]
+    out = np.empty((len(x), *shape, x.shape[-1]), dtype=np.uint8)
+
+    def resize_chunk(start):
+        xb = x[start:start + chunk]
+        if backend == 'tf':
+            out[start:start + len(xb)] = reshape(xb, shape).numpy()
+            return
+        for i, img in enumerate(xb):
+            resized = cv2.resize(img.astype(np.float32), shape[::-1], interpolation=cv2.INTER_LINEAR)
+            out[start + i] = resized.reshape(out.shape[1:]).astype(np.uint8)
+
+    starts = range(0, len(x), chunk)
+    if backend == 'tf':  # TF spreads a chunk over its own intra-op threads
+        for start in starts:
+            resize_chunk(start)
+    elif backend == 'cv2':
+        with ThreadPoolExecutor(n_threads or os.cpu_count()) as pool:
+            list(pool.map(resize_chunk, starts))
+    else:
+        raise Exception("No resize backend with name " + backend)
+    return out
+
+
+def data_fingerprint(dataset):
+    # everything that decides the preprocessed arrays, a change starts a new entry
+    h = hashlib.blake2b(digest_size=8)
+    h.update(f'{DATA_CACHE_VERSION}{dataset}{dataset in UPSCALED}{tf.__version__}{tfds.__version__}'.encode())
+    return f'{dataset}-{h.hexdigest()}'
+
+
+def load_data(dataset, split=None, cache=True):
+    # split 'train' or 'test' loads only that one, the other is None
+    # cached splits are read-only memory maps, processes loading the same dataset share their pages
+    if not cache:
+        return preprocess_data(dataset)
+    entry_path = join(DATA_CACHE_DIR, data_fingerprint(dataset))
+    if not exists(join(entry_path, 'meta.json')):
+        (x_train, y_train), (x_test, y_test), n_classes = preprocess_data(dataset)
+        staging_path = f'{entry_path}.{os.getpid()}.partial'
+        pathlib.Path(staging_path).mkdir(parents=True)
+        for name, arr in [('x_train', x_train), ('y_train', y_train), ('x_test', x_test), ('y_test', y_test)]:
+            np.save(join(staging_path, f'{name}.npy'), arr)
+        with open(join(staging_path, 'meta.json'), 'w') as f:
+            json.dump({'dataset': dataset, 'n_classes': int(n_classes)}, f)
+        try:
+            os.replace(staging_path, entry_path)
+        except OSError:  # built concurrently by another process
+            shutil.rmtree(staging_path)
+    with open(join(entry_path, 'meta.json')) as f:
+        n_classes = json.load(f)['n_classes']
+    splits = []
+    for name in ['train', 'test']:
+        if split in (None, name):
+            splits.append(tuple(np.load(join(entry_path, f'{v}_{name}.npy'), mmap_mode='r') for v in 'xy'))
+        else:
+            splits.append(None)
+    return splits[0], splits[1], n_classes
+
+
+def preprocess_data(dataset):
+    upscale = dataset in UPSCALED
     if dataset in ['mnist', 'fashion_mnist', 'cifar10', 'cifar100']:
         ds = {
             'mnist': mnist,
@@ -58,8 +167,8 @@ def load_data(dataset):
 
         split = ['train[:85%]', 'train[85%:]']
         trainDataset, testDataset = tfds.load(name=dataset, split=split, as_supervised=True)
-        trainDataset = trainDataset.map(lambda x, y: (transpose(x), y - 1))
-        testDataset = testDataset.map(lambda x, y: (transpose(x), y - 1))
+        trainDataset = trainDataset.map(lambda x, y: (transpose(x), y - 1), num_parallel_calls=tf.data.AUTOTUNE)
+        testDataset = testDataset.map(lambda x, y: (transpose(x), y - 1), num_parallel_calls=tf.data.AUTOTUNE)
         x_train, y_train = convert_tfds_to_numpy(trainDataset)
         x_test, y_test = convert_tfds_to_numpy(testDataset)
         return to_categorical_n_classes(x_train, y_train, x_test, y_test, upscale=upscale)
@@ -79,8 +188,8 @@ def load_data(dataset):
 
         split = ['train[:80%]', 'train[80%:]']
         trainDataset, testDataset = tfds.load(name=dataset, split=split, as_supervised=True)
-        testDataset = testDataset.map(preprocess)
-        trainDataset = trainDataset.map(preprocess)
+        testDataset = testDataset.map(preprocess, num_parallel_calls=tf.data.AUTOTUNE)
+        trainDataset = trainDataset.map(preprocess, num_parallel_calls=tf.data.AUTOTUNE)
         x_train, y_train = convert_tfds_to_numpy(trainDataset)
         x_test, y_test = convert_tfds_to_numpy(testDataset)
         classes = np.unique(y_train)
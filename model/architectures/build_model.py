@@ -6,7 +6,7 @@ from pprint import pprint
 from tensorflow.keras import Input
 from tensorflow.keras import Model
 from tensorflow.keras.layers import (
-    Concatenate, Add, Dense, Average, Dropout, GlobalAveragePooling2D, BatchNormalization
+    Concatenate, Add, Dense, Average, Dropout, GlobalAveragePooling2D, BatchNormalization, Rescaling
 )
 
 from enums import Aggregation
@@ -17,10 +17,10 @@ from model.train_configs import BATCH_SIZE
 from model.visualisation import plot_model
 
 
-def get_model(model_type, arch_dir, sub_input_shape, n_classes, m_id):
+def get_model(model_type, arch_dir, sub_input_shape, n_classes, m_id, uint8=False):
     name = model_type.name.lower()
-    _in = Input(shape=sub_input_shape)
-    x = network(_in, model_type, m_id, arch_dir)
+    _in = Input(shape=sub_input_shape, dtype='uint8' if uint8 else 'float32')
+    x = network(Rescaling(1 / 255)(_in) if uint8 else _in, model_type, m_id, arch_dir)
     _out = Dense(n_classes, activation='softmax')(x) if n_classes != 2 else Dense(1, activation='sigmoid')(x)
     model = Model(inputs=_in, outputs=_out, name=f'{name}_{m_id}')
     plot_model(arch_dir, model, name)
@@ -0,0 +1,184 @@
+import multiprocessing as mp
+import random
+import sys
+import threading
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+
+import albumentations as A
+import cv2
+import numpy as np
+
+AUG_SEED = 1234
+
+_worker = {}
+_pools = {}
+
+
+class ThreadRandom:
+    # stands in for the random module inside albumentations, a seeded thread draws from its own Random
+    def __init__(self):
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(getattr(self.local, 'rng', None) or random, name)
+
+
+_thread_random = ThreadRandom()
+
+
+def _patch_albumentations():
+    # albumentations<1.4 draws every parameter from the stdlib random module, numpy states via random_utils from it
+    patched = set()
+    for module in list(sys.modules.values()):
+        if getattr(module, '__name__', '').startswith('albumentations.'):
+            for name in ['random', 'py_random']:
+                if getattr(module, name, None) is random:
+                    setattr(module, name, _thread_random)
+                    patched.add(module.__name__)
+    if not {'albumentations.core.transforms_interface', 'albumentations.random_utils'} <= patched:
+        raise ImportError(f"albumentations {A.__version__} does not draw from the random module, "
+                          f"seeded augmentation needs albumentations<1.4")
+
+
+_patch_albumentations()
+
+
+def augmentation():
+    return A.Compose([
+        A.HorizontalFlip(),
+        A.CLAHE(),
+        A.ShiftScaleRotate(shift_limit=0.2, scale_limit=0.3, rotate_limit=45, p=.75),
+        A.OneOf([
+            A.MotionBlur(p=.20),
+            A.MedianBlur(blur_limit=3, p=0.20),
+            A.Blur(blur_limit=3, p=0.20),
+        ], p=0.3),
+        A.HueSaturationValue(p=0.35),
+    ])
+
+
+def seeded_augment(augmenter, image, seed):
+    # the image's own Random, keras worker threads augment concurrently without touching the global state
+    _thread_random.local.rng = random.Random(int(seed))
+    try:
+        return augmenter(image=image)['image']
+    finally:
+        _thread_random.local.rng = None
+
+
+def _check_seeding(n_seeds=8):
+    # a seeded image must not depend on the global random and np.random states, which threads share
+    image = np.random.RandomState(0).randint(0, 256, (32, 32, 3)).astype(np.uint8)
+    augmenter = augmentation()
+    states = random.getstate(), np.random.get_state()
+    try:
+        for seed in range(n_seeds):
+            outputs = []
+            for global_seed in range(2):
+                random.seed(global_seed)
+                np.random.seed(global_seed)
+                outputs.append(seeded_augment(augmenter, image, seed))
+            if not np.array_equal(*outputs):
+                raise ImportError(f"albumentations {A.__version__} draws from the global random state, "
+                                  f"seeded augmentation needs albumentations<1.4")
+    finally:
+        random.setstate(states[0])
+        np.random.set_state(states[1])
+
+
+_check_seeding()
+
+
+class SerialAugmenter:
+    # the batch interface of ParallelAugmenter, run in the calling thread
+    def __init__(self, augmenter=None):
+        self.augmenter = augmentation() if augmenter is None else augmenter
+
+    def __call__(self, x, seeds=None):
+        if seeds is None:
+            return np.array([self.augmenter(image=img.astype(np.uint8))['image'] for img in x])
+        return np.array([seeded_augment(self.augmenter, img.astype(np.uint8), s) for img, s in zip(x, seeds)])
+
+
+def _init_worker(seed, counter):
+    with counter.get_lock():
+        worker_id = counter.value
+        counter.value += 1
+    cv2.setNumThreads(1)
+    random.seed(seed + worker_id)
+    np.random.seed(seed + worker_id)
+    _worker['augmenter'] = augmentation()
+    _worker['blocks'] = {}
+
+
+def _attach(name, shape):
+    blocks = _worker['blocks']
+    if name not in blocks:
+        if len(blocks) >= 2:  # the parent grew its buffers, drop the stale pair
+            for old in blocks.values():
+                old.close()
+            blocks.clear()
+        blocks[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=np.uint8, buffer=blocks[name].buf)
+
+
+def _augment_rows(in_name, out_name, shape, start, stop, seeds=None):
+    # input and output batches live in shared memory, only names, row ranges and seeds are pickled
+    x = _attach(in_name, shape)
+    out = _attach(out_name, shape)
+    augmenter = _worker['augmenter']
+    for i in range(start, stop):
+        if seeds is None:
+            out[i] = augmenter(image=x[i])['image']
+        else:
+            out[i] = seeded_augment(augmenter, x[i], seeds[i - start])
+
+
+def _release(pool, blocks):
+    pool.terminate()
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+class ParallelAugmenter:
+    def __init__(self, n_workers, seed=AUG_SEED):
+        self.n_workers = n_workers
+        self.seed = seed
+        resource_tracker.ensure_running()  # workers must share it, or their own trackers unlink our buffers on exit
+        self.pool = mp.Pool(n_workers, initializer=_init_worker, initargs=(seed, mp.Value('i', 0)))
+        self.blocks = []  # [input, output] shared memory, grown on demand
+        self.lock = threading.Lock()
+        self.finalizer = weakref.finalize(self, _release, self.pool, self.blocks)
+
+    def buffers(self, shape):
+        size = int(np.prod(shape))
+        if not self.blocks or self.blocks[0].size < size:
+            for block in self.blocks:
+                block.close()
+                block.unlink()
+            self.blocks[:] = [shared_memory.SharedMemory(create=True, size=size) for _ in range(2)]
+        return [np.ndarray(shape, dtype=np.uint8, buffer=block.buf) for block in self.blocks]
+
+    def __call__(self, x, seeds=None):
+        with self.lock:
+            x_in, x_out = self.buffers(x.shape)
+            np.copyto(x_in, x, casting='unsafe')
+            bounds = np.linspace(0, len(x), min(self.n_workers, len(x)) + 1).astype(int)
+            self.pool.starmap(_augment_rows, [
+                (self.blocks[0].name, self.blocks[1].name, x.shape, start, stop,
+                 None if seeds is None else list(seeds[start:stop]))
+                for start, stop in zip(bounds[:-1], bounds[1:])
+            ])
+            return x_out.copy()
+
+    def close(self):
+        self.finalizer()
+
+
+def get_parallel_augmenter(n_workers):
+    # one pool per worker count, shared by every generator of the process
+    if n_workers not in _pools:
+        _pools[n_workers] = ParallelAugmenter(n_workers)
+    return _pools[n_workers]
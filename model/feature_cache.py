@@ -0,0 +1,131 @@
+import hashlib
+import os
+import pathlib
+from os.path import join, exists
+
+import numpy as np
+import tensorflow as tf
+
+from model.augmentation import AUG_SEED
+from model.generators import get_generator
+from model.train_configs import BATCH_SIZE, FEATURE_EPOCHS, USE_PATCH_CACHE
+from permutation.patch_cache import PatchCache, array_fingerprint, permutation_fingerprint
+
+FEATURE_CACHE_DIR = 'cache/features'
+FEATURE_CACHE_BUDGET = 10 * 2 ** 30  # bytes
+FEATURE_CHUNK = 512  # images encrypted and run through the backbones at a time
+
+
+def model_fingerprint(model):
+    # weights and output shape, a sub-model copied to another composite keeps its entries
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{model.output_shape}'.encode())
+    for w in model.get_weights():
+        h.update(np.ascontiguousarray(w).tobytes())
+    return h.hexdigest()
+
+
+class FeatureStore(PatchCache):
+    # outputs of frozen sub-models, one memory-mapped (n, features) .npy per (model, data, window, key, variant)
+    def __init__(self, root=FEATURE_CACHE_DIR, budget=FEATURE_CACHE_BUDGET):
+        super().__init__(root, budget)
+
+    def feature_path(self, model_key, data_key, coords, perm, variant):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f'{model_key}{data_key}{tuple(coords)}{variant}'.encode())
+        h.update(permutation_fingerprint(perm).encode())
+        return join(self.root, f'{h.hexdigest()}.npy')
+
+    def get_features(self, backbones, x, y, permutations, sub_input_shape, epoch=None, data_key=None):
+        # epoch None runs the plain images, otherwise the augmented pass of that epoch
+        if data_key is None:
+            data_key = array_fingerprint(x)
+        pathlib.Path(self.root).mkdir(exist_ok=True, parents=True)
+        variant = 'plain' if epoch is None else f'aug-{AUG_SEED}-{FEATURE_CHUNK}-{epoch}'
+        windows = list(permutations.items())
+        paths = [
+            self.feature_path(model_fingerprint(backbone), data_key, coords, perm, variant)
+            for backbone, (coords, perm) in zip(backbones, windows)
+        ]
+        while True:  # an entry evicted by another process between the build and the open is built again
+            missing = [i for i, path in enumerate(paths) if not exists(path)]
+            if missing:
+                print(f"Caching features of {len(missing)} sub-models for {len(x)} images ({variant})...")
+                gen = get_generator(
+                    x, y,
+                    permutations=dict(windows[i] for i in missing),
+                    sub_input_shape=sub_input_shape,
+                    augmented=epoch is not None,
+                    batch_size=FEATURE_CHUNK,
+                    patch_cache=USE_PATCH_CACHE,
+                    seed=AUG_SEED,
+                    uint8=backbones[0].inputs[0].dtype == tf.uint8,
+                )
+                gen.epoch = epoch or 0
+                tmp_paths = [f'{paths[i]}.{os.getpid()}.tmp' for i in missing]
+                entries = [
+                    np.lib.format.open_memmap(p, mode='w+', dtype=np.float32,
+                                              shape=(len(x), *backbones[i].output_shape[1:]))
+                    for p, i in zip(tmp_paths, missing)
+                ]
+                for b in range(int(np.ceil(len(x) / FEATURE_CHUNK))):
+                    xb, _ = gen[b]
+                    start = b * FEATURE_CHUNK
+                    for entry, i, xi in zip(entries, missing, xb):
+                        entry[start:start + len(xi)] = backbones[i].predict(xi, verbose=0)
+                for entry in entries:
+                    entry.flush()
+                del entries
+                for tmp_path, i in zip(tmp_paths, missing):
+                    os.replace(tmp_path, paths[i])
+                self.evict(keep=set(paths))
+            features = self.open_entries(paths)
+            if features is not None:
+                return features
+
+
+class FeatureSequence(tf.keras.utils.Sequence):
+    # batches of cached features, epoch e is served from passes[e % len(passes)]
+    def __init__(self, passes, y, batch_size=BATCH_SIZE, shuffle=False, seed=AUG_SEED):
+        self.passes = passes
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.order = self.epoch_order(0)
+
+    def epoch_order(self, epoch):
+        if not self.shuffle:
+            return np.arange(len(self.y))
+        return np.random.default_rng([self.seed, epoch]).permutation(len(self.y))
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.order = self.epoch_order(self.epoch)
+
+    def __getitem__(self, index):
+        # sorted rows keep the memmap reads sequential, the batch content is the same
+        indices = np.sort(self.order[index * self.batch_size:(index + 1) * self.batch_size])
+        features = self.passes[self.epoch % len(self.passes)]
+        return [f[indices] for f in features], self.y[indices]
+
+    def __len__(self):
+        return int(np.ceil(len(self.y) / self.batch_size))
+
+
+def get_feature_gens(backbones, x_train, y_train, x_val, y_val, permutations, sub_input_shape,
+                     n_epochs=FEATURE_EPOCHS):
+    store = FeatureStore()
+    train_key = array_fingerprint(x_train)
+    if n_epochs > 0:
+        passes = [
+            store.get_features(backbones, x_train, y_train, permutations, sub_input_shape, epoch=e, data_key=train_key)
+            for e in range(n_epochs)
+        ]
+    else:
+        passes = [store.get_features(backbones, x_train, y_train, permutations, sub_input_shape, data_key=train_key)]
+    valid = store.get_features(backbones, x_val, y_val, permutations, sub_input_shape)
+    train_ds = FeatureSequence(passes, y_train, shuffle=True)
+    valid_ds = FeatureSequence([valid], y_val)
+    return train_ds, valid_ds
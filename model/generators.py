@@ -1,9 +1,23 @@
-from model.train_configs import BATCH_SIZE
-from permutation.permutations import PermutationGenerator
-import albumentations as A
+import numpy as np
+import tensorflow as tf
 
+from datasets import FoldView
+from model.augmentation import SerialAugmenter, augmentation, get_parallel_augmenter
+from model.train_configs import BATCH_SIZE, AUG_WORKERS, DATA_SEED, INPUT_BACKEND, USE_PATCH_CACHE
+from permutation.patch_cache import PatchCache
+from permutation.permutations import PermutationGenerator, PatchExtractor
 
-def get_train_valid_gens(x_train, y_train, x_val, y_val, permutations, sub_input_shape, examples_path, save_examples=False):
+
+def get_train_valid_gens(x_train, y_train, x_val, y_val, permutations, sub_input_shape, examples_path, save_examples=False,
+                         backend=INPUT_BACKEND, uint8=False):
+    if backend == 'tf':
+        if save_examples:
+            get_generator(x_val, y_val, batch_size=BATCH_SIZE, permutations=permutations, examples_path=examples_path,
+                          save_examples=True, sub_input_shape=sub_input_shape, seed=0)
+        train_ds = get_dataset(x_train, y_train, permutations, sub_input_shape, BATCH_SIZE, augmented=True, shuffle=True,
+                               uint8=uint8)
+        valid_ds = get_dataset(x_val, y_val, permutations, sub_input_shape, BATCH_SIZE, cache=True, uint8=uint8)
+        return train_ds, valid_ds
     train_ds = get_generator(
         x_train, y_train,
         batch_size=BATCH_SIZE,
@@ -13,6 +27,8 @@ def get_train_valid_gens(x_train, y_train, x_val, y_val, permutations, sub_input
         examples_path=examples_path,
         save_examples=False,
         shuffle=True,
+        seed=DATA_SEED,
+        uint8=uint8,
     )
     valid_ds = get_generator(
         x_val, y_val,
@@ -20,7 +36,10 @@ def get_train_valid_gens(x_train, y_train, x_val, y_val, permutations, sub_input
         permutations=permutations,
         examples_path=examples_path,
         save_examples=save_examples,
-        sub_input_shape=sub_input_shape
+        sub_input_shape=sub_input_shape,
+        seed=DATA_SEED,
+        patch_cache=USE_PATCH_CACHE,
+        uint8=uint8,
     )
     return train_ds, valid_ds
 
@@ -34,27 +53,52 @@ def get_generator(
         shuffle=False,
         save_examples=False,
         batch_size=None,
+        seed=None,
+        patch_cache=False,
+        uint8=False,
 ):
-    aug = augmentation() if augmented else None
+    aug = None
+    patches = None
+    if seed is None and isinstance(x, FoldView):
+        # keras' flow() would copy the fold, index mode gathers every batch from the base array
+        seed = np.random.randint(2 ** 31)
+    if augmented:
+        aug = get_parallel_augmenter(AUG_WORKERS) if AUG_WORKERS > 0 else SerialAugmenter()
+    elif patch_cache:
+        # un-augmented windows never change, reuse them across epochs, folds and configs
+        patches = PatchCache().get_patches(x, permutations, sub_input_shape)
+        seed = 0 if seed is None else seed
     perm_gen = PermutationGenerator(
         x, y, aug,
         subinput_shape=sub_input_shape, permutations=permutations, batch_size=batch_size, examples_path=examples_path,
-        shuffle_dataset=shuffle
+        shuffle_dataset=shuffle, seed=seed, patches=patches, uint8=uint8
     )
     if save_examples:
         perm_gen.generate_and_save_examples()
     return perm_gen
 
 
-def augmentation():
-    return A.Compose([
-        A.HorizontalFlip(),
-        A.CLAHE(),
-        A.ShiftScaleRotate(shift_limit=0.2, scale_limit=0.3, rotate_limit=45, p=.75),
-        A.OneOf([
-            A.MotionBlur(p=.20),
-            A.MedianBlur(blur_limit=3, p=0.20),
-            A.Blur(blur_limit=3, p=0.20),
-        ], p=0.3),
-        A.HueSaturationValue(p=0.35),
-    ])
+
+def get_dataset(x, y, permutations, sub_input_shape, batch_size, augmented=False, shuffle=False, cache=False,
+                drop_remainder=True, uint8=False):
+    # tf.data counterpart of get_generator, cropping and permutations run as TF ops in its threadpool
+    extractor = PatchExtractor(permutations, sub_input_shape)
+    ds = tf.data.Dataset.from_tensor_slices((np.asarray(x, dtype=np.uint8), np.asarray(y)))  # fold views copied here
+    if shuffle:
+        ds = ds.shuffle(len(x), reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size, drop_remainder=drop_remainder)
+    if augmented:
+        aug = augmentation()
+
+        def augment(xb):
+            return np.array([aug(image=img)['image'] for img in xb])
+
+        def augment_batch(xb, yb):
+            xb = tf.ensure_shape(tf.numpy_function(augment, [xb], tf.uint8), xb.shape)
+            return xb, yb
+
+        ds = ds.map(augment_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    ds = ds.map(lambda xb, yb: (extractor.tf_patches(xb, uint8), yb), num_parallel_calls=tf.data.AUTOTUNE)
+    if cache and not augmented:
+        ds = ds.cache()
+    return ds.prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,49 @@
+import hashlib
+import os
+import shutil
+from os.path import join, exists
+
+from model.architectures.model_configs import get_config
+from model.train_configs import UINT8_INPUTS
+from permutation.patch_cache import array_fingerprint, permutation_fingerprint
+
+MODEL_STORE_DIR = 'experiments/sub_models'
+STORE_VERSION = 1
+
+
+def fold_fingerprint(x_train, y_train, x_val, y_val):
+    # the dataset and the fold indices, through the content of the split they produce
+    h = hashlib.blake2b(digest_size=16)
+    for arr in (x_train, y_train, x_val, y_val):
+        h.update(array_fingerprint(arr).encode())
+    return h.hexdigest()
+
+
+class ModelStore:
+    # trained sub-models addressed by everything that determines them, composites hold hardlinked trees of entries
+    def __init__(self, root=MODEL_STORE_DIR):
+        self.root = root
+
+    def entry_path(self, data_key, arch, n_classes, sub_input_shape, coords, perm):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f'{STORE_VERSION}{data_key}{arch.name}{get_config(arch)}{n_classes}'.encode())
+        h.update(f'{tuple(sub_input_shape)}{tuple(coords)}'.encode())
+        h.update(permutation_fingerprint(perm).encode())
+        if UINT8_INPUTS:
+            h.update(b'uint8')
+        return join(self.root, h.hexdigest())
+
+    @staticmethod
+    def link(entry_path, sub_model_path):
+        print(f"Linking {entry_path} to {sub_model_path}")
+        staging_path = f'{sub_model_path}.partial'
+        if exists(staging_path):
+            shutil.rmtree(staging_path)
+        try:
+            shutil.copytree(entry_path, staging_path, copy_function=os.link)
+        except OSError:  # store on another filesystem
+            shutil.rmtree(staging_path, ignore_errors=True)
+            shutil.copytree(entry_path, staging_path)
+        if exists(sub_model_path):
+            shutil.rmtree(sub_model_path)
+        os.replace(staging_path, sub_model_path)
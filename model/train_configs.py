@@ -9,10 +9,27 @@ from tensorflow.keras.losses import categorical_crossentropy, binary_crossentrop
 from tensorflow.keras.metrics import Precision, Recall
 from tensorflow.keras.optimizers import SGD, Adam
 
-from model.utils import PlotProgress
+from model.utils import PlotProgress, MetricsLog
 
 BATCH_SIZE = 64
 MAX_EPOCHS = 200
+PREDICT_CHUNK = 512  # test images encrypted and predicted at a time, a multiple of the keras predict batch (32)
+AUG_WORKERS = 0  # > 0 runs augmentation in a pool of that many processes
+DATA_SEED = None  # not None makes batches a pure function of (index, epoch, seed), required for DATA_WORKERS > 1
+DATA_WORKERS = 1
+USE_MULTIPROCESSING = False
+INPUT_BACKEND = 'numpy'  # 'numpy' for PermutationGenerator, 'tf' for the tf.data pipeline
+USE_PATCH_CACHE = False  # encrypted validation and test windows kept on disk, up to 10 GB in cache/patches
+CACHE_FEATURES = False  # train composite heads on cached sub-model outputs, see model/feature_cache.py
+FEATURE_EPOCHS = 0  # augmented passes of the training set cached for the head, 0 caches it un-augmented
+SUB_WORKERS = 1  # > 1 trains the sub-models of a composite concurrently, one process each
+SUB_INTRA_THREADS = None  # TF intra-op threads per sub-model process, None splits the cores between the processes
+SUB_INTER_THREADS = 2
+UINT8_INPUTS = False  # batches stay uint8 end to end, new models scale them in a Rescaling layer
+PIPELINE_STATS = True  # per-epoch data wait, step and generator stage times in train/pipeline.csv
+PROFILE_STEPS = None  # (first, last) train step traced with tf.profiler into train/profile
+TELEMETRY = 'lean'  # 'lean' logs metrics per epoch and plots after training, 'full' plots and histograms every epoch
+HISTOGRAM_FREQ = 10  # epochs between weight histograms in lean telemetry, 0 disables them
 
 
 def scheduler(start_ep=15, decay_rate=-0.03, min_rate=5e-7):
@@ -64,6 +81,17 @@ def callbacks(checkpoints_dir, training_info_dir, name):
             verbose=1,
             min_lr=5e-7
         ),
-        PlotProgress(training_info_dir, name),
-        TensorBoard(log_dir=f'{training_info_dir}/graph', histogram_freq=1, write_graph=True, write_images=True)
+    ] + telemetry(training_info_dir, name)
+
+
+def telemetry(training_info_dir, name, mode=TELEMETRY):
+    if mode == 'full':
+        return [
+            PlotProgress(training_info_dir, name),
+            TensorBoard(log_dir=f'{training_info_dir}/graph', histogram_freq=1, write_graph=True, write_images=True)
+        ]
+    return [
+        MetricsLog(training_info_dir, name),
+        TensorBoard(log_dir=f'{training_info_dir}/graph', histogram_freq=HISTOGRAM_FREQ, write_graph=True,
+                    write_images=False, profile_batch=0)
     ]
@@ -1,26 +1,38 @@
+import multiprocessing as mp
 import pathlib
 import pickle
 import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # suppress logging
 from os.path import join, exists
 
 import numpy as np
+import tensorflow as tf
 from matplotlib import pyplot as plt
 from pretty_confusion_matrix import pp_matrix_from_data
 from sklearn.metrics import classification_report, accuracy_score
 from tensorflow.keras import Model
-from tensorflow.keras.layers import Input
+from tensorflow.keras.layers import Input, InputLayer
 from tensorflow.keras.models import load_model
 # from keras.utils.generic_utils import CustomMaskWarning
 
+from datasets import FoldView
 from enums import Aggregation
 from model.architectures.build_model import get_model, aggregate
-from model.generators import get_train_valid_gens, get_generator
-from model.train_configs import compile_options, MAX_EPOCHS, BATCH_SIZE, callbacks
-from model.utils import save_training_info, set_up_dirs
+from model.augmentation import ParallelAugmenter
+from model.feature_cache import get_feature_gens
+from model.generators import get_train_valid_gens, get_generator, get_dataset
+from model.model_store import ModelStore, fold_fingerprint
+from model.train_configs import compile_options, MAX_EPOCHS, BATCH_SIZE, callbacks, DATA_WORKERS, USE_MULTIPROCESSING, \
+    INPUT_BACKEND, USE_PATCH_CACHE, PREDICT_CHUNK, CACHE_FEATURES, SUB_WORKERS, SUB_INTRA_THREADS, SUB_INTER_THREADS, \
+    UINT8_INPUTS, PIPELINE_STATS, PROFILE_STEPS
+from model.utils import save_training_info, set_up_dirs, serving_dir_name, PipelineStats
 from model.visualisation import plot_model
-from permutation.permutations import generate_permutations
+from permutation.permutations import generate_permutations, PermutationGenerator, PermutationLayer, save_keys, \
+    load_keys
 
 import warnings
 from sklearn.exceptions import UndefinedMetricWarning
@@ -37,7 +49,7 @@ def train_model(x_train, y_train, x_val, y_val, model_path, permutations, sub_in
     train_dirs = (model_path, checkpoints_dir, training_info_dir)
     save_permutation(model_path, permutations)
     if mode == 'single':
-        model = get_model(arch, arch_info_dir, sub_input_shape, n_classes, m_id=m_id)
+        model = get_model(arch, arch_info_dir, sub_input_shape, n_classes, m_id=m_id, uint8=UINT8_INPUTS)
         model.compile(**compile_options(n_classes))
         name = f'{ds_name}-{arch.name.lower()}-{mode}-{m_id}'
         generators = get_train_valid_gens(
@@ -46,22 +58,36 @@ def train_model(x_train, y_train, x_val, y_val, model_path, permutations, sub_in
             sub_input_shape=sub_input_shape,
             examples_path=examples_info_dir,
             save_examples=True,
+            uint8=UINT8_INPUTS,
         )
         fit_model(model, generators, train_dirs, name)
         return model
 
     models = []
     if mode == 'composite':
-        sub_model_paths = []
-        for i, (coords, perm) in enumerate(permutations.items()):
-            sub_perm = {coords: perm}
-            sub_model_path = join(model_path, "subs", str(i))
-            sub_model_paths.append(sub_model_path)
-            if not skip_training(sub_model_path):
-                train_model(
-                    x_train, y_train, x_val, y_val, sub_model_path, sub_perm, sub_input_shape, n_classes,
-                    ds_name, arch, mode='single', m_id=i,
-                )
+        sub_model_paths = [join(model_path, "subs", str(i)) for i in range(len(permutations))]
+        missing = [
+            (i, sub_model_path, coords, perm)
+            for i, (sub_model_path, (coords, perm)) in enumerate(zip(sub_model_paths, permutations.items()))
+            if not skip_training(sub_model_path)
+        ]
+        # trained into the store and linked from there, any composite sharing a window and key reuses them
+        store = ModelStore()
+        data_key = fold_fingerprint(x_train, y_train, x_val, y_val) if missing else None
+        links, jobs = [], []
+        for i, sub_model_path, coords, perm in missing:
+            entry_path = store.entry_path(data_key, arch, n_classes, sub_input_shape, coords, perm)
+            if not skip_training(entry_path) and entry_path not in [job[0] for job in jobs]:
+                jobs.append((entry_path, {coords: perm}, i))
+            links.append((entry_path, sub_model_path))
+        sub_args = (sub_input_shape, n_classes, ds_name, arch)
+        if SUB_WORKERS > 1 and len(jobs) > 1:
+            train_sub_models_parallel((x_train, y_train, x_val, y_val), jobs, sub_args)
+        else:
+            for entry_path, sub_perm, i in jobs:
+                train_sub_model(x_train, y_train, x_val, y_val, entry_path, sub_perm, *sub_args, m_id=i)
+        for entry_path, sub_model_path in links:
+            store.link(entry_path, sub_model_path)
 
         for sub_path in sub_model_paths:
             model = load_model(sub_path)
@@ -70,7 +96,7 @@ def train_model(x_train, y_train, x_val, y_val, model_path, permutations, sub_in
             model.trainable = False
             models.append(model)
 
-    inputs = [Input(shape=sub_input_shape) for _ in models]
+    inputs = [Input(shape=sub_input_shape, dtype=model.input.dtype) for model in models]
     models_outputs = [model(inpt) for model, inpt in zip(models, inputs)]
     outputs = aggregate(models_outputs, n_classes, aggr_scheme)
     aggregated_model = Model(inputs=inputs, outputs=outputs, name=mode)
@@ -78,28 +104,110 @@ def train_model(x_train, y_train, x_val, y_val, model_path, permutations, sub_in
     plot_model(arch_info_dir, aggregated_model, mode)
     aggregated_model.compile(**compile_options(n_classes))
     name = f'{ds_name}-{arch.name.lower()}-{mode}'
+    uint8 = uint8_inputs(aggregated_model)  # follows the sub-models, which may predate a change of UINT8_INPUTS
+    if CACHE_FEATURES and mode == 'composite':
+        # the sub-models are frozen, only the head is fit and it reads their outputs from the feature store
+        get_generator(x_val, y_val, batch_size=BATCH_SIZE, permutations=permutations, examples_path=examples_info_dir,
+                      save_examples=True, sub_input_shape=sub_input_shape, seed=0, uint8=uint8)
+        head = split_head(aggregated_model)
+        head.compile(**compile_options(n_classes))
+        generators = get_feature_gens(models, x_train, y_train, x_val, y_val, permutations, sub_input_shape)
+        fit_model(head, generators, train_dirs, name, saved_model=aggregated_model)
+        export_serving_model(model_path, x_train.shape[1:], aggregated_model)
+        return aggregated_model
     generators = get_train_valid_gens(
         x_train, y_train, x_val, y_val,
         permutations=permutations,
         sub_input_shape=sub_input_shape,
         examples_path=examples_info_dir,
         save_examples=True,
+        uint8=uint8,
     )
     fit_model(aggregated_model, generators, train_dirs, name)
+    if mode == 'composite':
+        export_serving_model(model_path, x_train.shape[1:], aggregated_model)
     return aggregated_model
 
 
-def fit_model(model, data, dirs, name, skip=False):
+def train_sub_model(x_train, y_train, x_val, y_val, sub_model_path, sub_perm, sub_input_shape, n_classes, ds_name,
+                    arch, m_id):
+    # trained in a staging directory renamed into place once saved, skip_training never sees a half-written sub-model
+    staging_path = f'{sub_model_path}.partial'
+    if exists(staging_path):
+        shutil.rmtree(staging_path)
+    train_model(x_train, y_train, x_val, y_val, staging_path, sub_perm, sub_input_shape, n_classes, ds_name, arch,
+                mode='single', m_id=m_id)
+    if exists(sub_model_path):
+        shutil.rmtree(sub_model_path)
+    os.replace(staging_path, sub_model_path)
+
+
+def set_tf_threads(intra_threads, inter_threads):
+    tf.config.threading.set_intra_op_parallelism_threads(intra_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_threads)
+
+
+def share_array(data_dir, name, arr):
+    # written once to a memory-mapped file, a fold view of a file-backed array only writes its indices
+    if isinstance(arr, FoldView) and isinstance(arr.base, np.memmap):
+        np.save(join(data_dir, f'{name}-indices.npy'), arr.indices)
+        return arr.base.filename, join(data_dir, f'{name}-indices.npy')
+    np.save(join(data_dir, f'{name}.npy'), arr)
+    return join(data_dir, f'{name}.npy'), None
+
+
+def load_shared_array(path, indices_path):
+    arr = np.load(path, mmap_mode='r')
+    return arr if indices_path is None else FoldView(arr, np.load(indices_path))
+
+
+def _train_sub_worker(shared, sub_model_path, sub_perm, sub_args, m_id):
+    data = [load_shared_array(*spec) for spec in shared]
+    train_sub_model(*data, sub_model_path, sub_perm, *sub_args, m_id=m_id)
+
+
+def train_sub_models_parallel(data, jobs, sub_args):
+    # workers map the splits from files instead of receiving pickled copies
+    n_workers = min(SUB_WORKERS, len(jobs))
+    intra_threads = SUB_INTRA_THREADS or max(1, os.cpu_count() // n_workers)
+    data_dir = tempfile.mkdtemp(prefix='sub-data-')
+    try:
+        shared = [share_array(data_dir, str(i), arr) for i, arr in enumerate(data)]
+        with ProcessPoolExecutor(n_workers, mp_context=mp.get_context('spawn'), initializer=set_tf_threads,
+                                 initargs=(intra_threads, SUB_INTER_THREADS)) as pool:
+            futures = [
+                pool.submit(_train_sub_worker, shared, sub_model_path, sub_perm, sub_args, i)
+                for sub_model_path, sub_perm, i in jobs
+            ]
+            for future in as_completed(futures):
+                future.result()
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def fit_model(model, data, dirs, name, skip=False, saved_model=None):
     print("Training ", name)
     model_path, checkpoints_dir, training_info_dir = dirs
     train_ds, valid_ds = data
     if not skip:
+        fit_options = {}
+        if isinstance(train_ds, PermutationGenerator):
+            # stateful generators must be consumed in order by a single worker
+            deterministic = train_ds.seed is not None and valid_ds.seed is not None
+            fit_options = {
+                'shuffle': not deterministic,
+                'workers': DATA_WORKERS if deterministic else 1,
+                'use_multiprocessing': deterministic and USE_MULTIPROCESSING and not isinstance(
+                    train_ds.augmenter, ParallelAugmenter
+                ),
+            }
         try:
             model.fit(
                 train_ds, epochs=MAX_EPOCHS, verbose=1, validation_data=valid_ds,
-                steps_per_epoch=train_ds.n // BATCH_SIZE,
-                validation_steps=valid_ds.n // BATCH_SIZE,
-                callbacks=callbacks(checkpoints_dir, training_info_dir, name)
+                steps_per_epoch=len(train_ds),
+                validation_steps=len(valid_ds),
+                callbacks=fit_callbacks(train_ds, checkpoints_dir, training_info_dir, name),
+                **fit_options
             )
         except KeyboardInterrupt:
             print("\nInterrupted!")
@@ -107,14 +215,39 @@ def fit_model(model, data, dirs, name, skip=False):
         if exists(best_weights):
             model.load_weights(best_weights)
     print(f"Saving {model_path}...")
-    model.save(model_path)
+    (model if saved_model is None else saved_model).save(model_path)
     save_training_info(model, training_info_dir)
     print("Model saved")
     return model
 
 
+def fit_callbacks(train_ds, checkpoints_dir, training_info_dir, name):
+    cbs = callbacks(checkpoints_dir, training_info_dir, name)
+    if PIPELINE_STATS or PROFILE_STEPS is not None:
+        cbs.append(PipelineStats(training_info_dir, getattr(train_ds, 'timer', None), PROFILE_STEPS))
+    return cbs
+
+
+def export_serving_model(model_path, image_shape, model=None):
+    # whole uint8 images in, cropping and permutations run in the graph, no preprocessing outside TF
+    if model is None:
+        model = load_model(model_path)
+    permutations = load_permutation(model_path)
+    sub_input_shape = tuple(model.inputs[0].shape[1:])
+    image = Input(shape=image_shape, dtype='uint8')
+    windows = PermutationLayer.from_permutations(
+        permutations, sub_input_shape, image_shape, uint8_inputs(model), name='permutations'
+    )(image)
+    outputs = model(list(windows) if len(model.inputs) > 1 else windows[0])
+    serving_model = Model(inputs=image, outputs=outputs, name=f'{model.name}_serving')
+    serving_path = join(model_path, serving_dir_name)
+    print(f"Exporting {serving_path}...")
+    serving_model.save(serving_path)
+    return serving_model
+
+
 def predict(model_path, x_test, y_test, sub_input_shape, classes_names, mode=None, test_dir_name=None,
-            invalid_test=None):
+            invalid_test=None, backend=INPUT_BACKEND, model=None):
     permutations = load_permutation(model_path)
     if type(invalid_test) == dict:
         permutations = generate_permutations(
@@ -128,25 +261,63 @@ def predict(model_path, x_test, y_test, sub_input_shape, classes_names, mode=Non
         test_dir_name = 'test'
     testing_path = join(model_path, test_dir_name)
 
-    if mode == 'composite':
-        sub_predictions = []
-        for i, _ in enumerate(permutations):
-            sub_model_path = join(model_path, "subs", str(i))
-            acc = predict(sub_model_path, x_test, y_test, sub_input_shape, classes_names, mode='single',
-                          test_dir_name=test_dir_name, invalid_test=invalid_test)
-            sub_predictions.append(acc)
-        np.save(join(testing_path, 'sub_preds.npy'), sub_predictions)
-
     print("Predicting ", model_path)
-    model = load_model(model_path)
+    if model is None:
+        model = load_model(model_path)
     pathlib.Path(testing_path).mkdir(exist_ok=True, parents=True)
+    batches = test_batches(x_test, y_test, permutations, sub_input_shape, backend, uint8=uint8_inputs(model))
+    if mode == 'composite':
+        prediction, sub_predictions = predict_composite(model, model_path, batches)
+        sub_accuracies = []
+        for i, sub_prediction in enumerate(sub_predictions):
+            sub_testing_path = join(model_path, "subs", str(i), test_dir_name)
+            pathlib.Path(sub_testing_path).mkdir(exist_ok=True, parents=True)
+            sub_accuracies.append(save_test_report(sub_testing_path, y_test, sub_prediction, classes_names))
+        np.save(join(testing_path, 'sub_preds.npy'), sub_accuracies)
+    else:
+        prediction = np.concatenate([model.predict(x, verbose=0) for x in batches])
+    return save_test_report(testing_path, y_test, prediction, classes_names)
+
+
+def test_batches(x_test, y_test, permutations, sub_input_shape, backend=INPUT_BACKEND, uint8=False):
+    # only one chunk of patches is alive at a time, peak memory does not grow with the test set
+    if backend == 'tf':
+        test_ds = get_dataset(x_test, y_test, permutations, sub_input_shape, PREDICT_CHUNK, drop_remainder=False,
+                              uint8=uint8)
+        for x, _ in test_ds:
+            yield list(x)
+        return
     test_gen = get_generator(x_test, y_test,
-                             batch_size=len(x_test),
+                             batch_size=PREDICT_CHUNK,
                              permutations=permutations,
-                             sub_input_shape=sub_input_shape)
-    x_test, y_test = test_gen.next()
-    prediction = model.predict(x_test)
+                             sub_input_shape=sub_input_shape,
+                             patch_cache=USE_PATCH_CACHE,
+                             seed=0,
+                             uint8=uint8)
+    for i in range(int(np.ceil(test_gen.n / test_gen.batch_size))):
+        x, _ = test_gen[i]
+        yield x
 
+
+def predict_composite(model, model_path, batches):
+    # every frozen backbone runs once per input, its features feed both its own softmax and the aggregation head
+    head = split_head(model)
+    backbones = [layer for layer in model.layers if isinstance(layer, Model)]
+    classifiers = []
+    for i, backbone in enumerate(backbones):
+        sub_model = load_model(join(model_path, "subs", str(i)))
+        stripped = backbone.output_shape != sub_model.output_shape
+        classifiers.append(sub_model.layers[-1] if stripped else None)
+    predictions, sub_predictions = [], [[] for _ in backbones]
+    for x in batches:
+        features = [backbone.predict(xi, verbose=0) for backbone, xi in zip(backbones, x)]
+        for sub_prediction, classifier, f in zip(sub_predictions, classifiers, features):
+            sub_prediction.append(classifier(f).numpy() if classifier else f)
+        predictions.append(head.predict(features, verbose=0))
+    return np.concatenate(predictions), [np.concatenate(p) for p in sub_predictions]
+
+
+def save_test_report(testing_path, y_test, prediction, classes_names):
     actual_classes = np.argmax(y_test, axis=1)
     predicted_classes = np.argmax(prediction, axis=1)
     plt.ion()
@@ -162,12 +333,13 @@ def predict(model_path, x_test, y_test, sub_input_shape, classes_names, mode=Non
 
 
 def save_permutation(folder, perm):
-    with open(join(folder, "permutations"), 'wb') as f:
-        pickle.dump(perm, f)
+    save_keys(join(folder, "permutations.npz"), perm)
 
 
 def load_permutation(folder):
-    with open(join(folder, "permutations"), 'rb') as f:
+    if exists(join(folder, "permutations.npz")):
+        return load_keys(join(folder, "permutations.npz"))
+    with open(join(folder, "permutations"), 'rb') as f:  # models saved before the compact key tables
         return pickle.load(f)
 
 
@@ -180,3 +352,21 @@ def skip_training(model_path):
 
 def strip_last_layer(model):
     return Model(inputs=model.input, outputs=model.layers[-2].output, name=model.name)
+
+
+def uint8_inputs(model):
+    return model.inputs[0].dtype == tf.uint8
+
+
+def split_head(model):
+    # aggregation part of a composite model as a model of its own, fed with the outputs of the sub-models
+    backbones = [layer for layer in model.layers if isinstance(layer, Model)]
+    head_inputs = [Input(shape=backbone.output_shape[1:]) for backbone in backbones]
+    tensors = {backbone.name: x for backbone, x in zip(backbones, head_inputs)}
+    for layer in model.layers:
+        if isinstance(layer, InputLayer) or layer.name in tensors:
+            continue
+        inbound = layer.inbound_nodes[0].inbound_layers
+        x = [tensors[l.name] for l in inbound] if isinstance(inbound, list) else tensors[inbound.name]
+        tensors[layer.name] = layer(x)
+    return Model(inputs=head_inputs, outputs=tensors[model.layers[-1].name], name=f'{model.name}_head')
@@ -1,3 +1,5 @@
+import csv
+import json
 import os.path
 import pathlib
 import sys
@@ -7,6 +9,7 @@ from os.path import join
 from pprint import pprint
 
 import numpy as np
+import tensorflow as tf
 from tensorflow.keras.callbacks import Callback
 from matplotlib import pyplot as plt
 
@@ -14,6 +17,9 @@ info_dir_name = "train"
 examples_dir_name = 'data_examples'
 arch_dir_name = 'architecture'
 testing_dir_name = 'test'
+serving_dir_name = 'serving'
+pipeline_stats_name = 'pipeline'
+metrics_log_name = 'metrics.jsonl'
 
 
 def save_training_info(model, training_info_dir):
@@ -89,21 +95,15 @@ class PlotProgress(Callback):
     def on_epoch_end(self, epoch, logs=None):
         if logs is None:
             logs = {}
+        self.update(logs)
+        self.draw(epoch, logs)
+
+    def update(self, logs):
         for metric in logs:
             if metric in self.metrics:
                 self.metrics[metric].append(logs.get(metric))
             else:
                 self.metrics[metric] = [logs.get(metric)]
-        n_met = len([x for x in logs if 'val' not in x])
-        if self.f is None:
-            if n_met > 3:
-                self.f, self.axs = plt.subplots(2, 3, figsize=(12, 8))
-            else:
-                self.f, self.axs = plt.subplots(1, 3, figsize=(12, 4))
-        self.f.suptitle(
-            f'{self.name}  training time: {str(timedelta(seconds=time.time() - self.start_time)).split(".")[0]}'
-        )
-
         acc = max(self.max_acc, round(logs.get("accuracy"), 4))
         val_acc = max(self.max_val_acc, round(logs.get("val_accuracy"), 4))
         loss = min(self.min_loss, round(logs.get("loss"), 4))
@@ -132,6 +132,18 @@ class PlotProgress(Callback):
         self.max_val_acc = val_acc
         self.min_loss = loss
         self.min_val_loss = val_loss
+
+    def draw(self, epoch, logs):
+        n_met = len([x for x in logs if 'val' not in x])
+        if self.f is None:
+            if n_met > 3:
+                self.f, self.axs = plt.subplots(2, 3, figsize=(12, 8))
+            else:
+                self.f, self.axs = plt.subplots(1, 3, figsize=(12, 4))
+        self.f.suptitle(
+            f'{self.name}  training time: {str(timedelta(seconds=time.time() - self.start_time)).split(".")[0]}'
+        )
+
         acc_msg = f"{'Max accuracy': <16}: {self.max_acc:.4f}, not impr. in {self.acc_ep} epochs\n{'Max val_accuracy': <16}: {self.max_val_acc:.4f}, not impr. in {self.val_acc_ep} epochs"
         loss_msg = f"{'Min loss': <16}: {self.min_loss:.4f}, not impr. in {self.loss_ep} epochs\n{'Min val_loss': <16}: {self.min_val_loss:.4f}, not impr. in {self.val_loss_ep} epochs"
         metrics = [x for x in logs if 'val' not in x]
@@ -156,3 +168,129 @@ class PlotProgress(Callback):
         self.f.canvas.draw()
         self.f.canvas.flush_events()
         self.f.savefig(f"{self.info_dir}/progress.png")
+
+
+class MetricsLog(Callback):
+    # one json line per epoch, the PlotProgress figure is drawn from it once after training
+    def __init__(self, info_dir, name):
+        super().__init__()
+        self.info_dir = info_dir
+        self.name = name
+        self.path = join(info_dir, metrics_log_name)
+        self.start_time = None
+        self.rows = []
+
+    def on_train_begin(self, logs=None):
+        pathlib.Path(self.info_dir).mkdir(exist_ok=True, parents=True)
+        open(self.path, 'w').close()
+        self.start_time = time.time()
+        self.rows = []
+
+    def on_epoch_end(self, epoch, logs=None):
+        row = {'epoch': epoch, 'time': time.time() - self.start_time}
+        row.update({k: float(v) for k, v in (logs or {}).items()})
+        self.rows.append(row)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(row) + '\n')
+
+    def on_train_end(self, logs=None):
+        render_progress(self.info_dir, self.name, self.rows)  # inline, a spawned renderer re-imports TF for seconds
+
+
+def read_metrics_log(info_dir):
+    with open(join(info_dir, metrics_log_name)) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def render_progress(info_dir, name, rows=None):
+    if rows is None:
+        rows = read_metrics_log(info_dir)
+    if not rows:
+        return
+    plt.switch_backend('Agg')
+    progress = PlotProgress(info_dir, name)
+    for row in rows:
+        logs = {k: v for k, v in row.items() if k not in ('epoch', 'time')}
+        progress.update(logs)
+    progress.start_time = time.time() - rows[-1]['time']
+    progress.draw(len(rows) - 1, logs)
+    plt.close('all')
+
+
+class PipelineStats(Callback):
+    # per epoch time in train steps and the part of it spent waiting for batches, with the generator stage times
+    # a step waits from its start until the generator finished the batch it consumes, batches are consumed in order
+    def __init__(self, info_dir, timer=None, profile_steps=None):
+        super().__init__()
+        self.info_dir = info_dir
+        self.timer = timer
+        self.profile_steps = profile_steps  # (first, last) global train step traced by tf.profiler
+        self.csv_path = join(info_dir, f'{pipeline_stats_name}.csv')
+        self.writer = None
+        self.global_step = 0
+        self.step_start = 0
+        self.reset_epoch()
+
+    def reset_epoch(self):
+        self.steps = 0
+        self.step_time = 0
+        self.data_wait = 0
+        self.waits_known = True
+
+    def on_train_begin(self, logs=None):
+        pathlib.Path(self.info_dir).mkdir(exist_ok=True, parents=True)
+        self.writer = tf.summary.create_file_writer(join(self.info_dir, 'graph', pipeline_stats_name))
+        if self.timer is not None:
+            self.timer.reset(clear_ready=True)  # batches drawn before fit, e.g. for the examples
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.reset_epoch()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.profile_steps is not None and self.global_step == self.profile_steps[0]:
+            tf.profiler.experimental.start(join(self.info_dir, 'profile'))
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        end = time.perf_counter()
+        step = end - self.step_start
+        ready = None if self.timer is None else self.timer.pop_ready()
+        if ready is None:  # tf.data input or generator copies in worker processes
+            self.waits_known = False
+        else:
+            self.data_wait += min(max(ready - self.step_start, 0), step)
+        self.steps += 1
+        self.step_time += step
+        if self.profile_steps is not None and self.global_step == self.profile_steps[1]:
+            tf.profiler.experimental.stop()
+        self.global_step += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        totals, batches = self.timer.reset() if self.timer is not None else ({}, 0)
+        row = {
+            'epoch': epoch,
+            'steps': self.steps,
+            'step_time': self.step_time,
+            'data_wait': self.data_wait if self.waits_known else float('nan'),
+            'wait_fraction': self.data_wait / max(self.step_time, 1e-9) if self.waits_known else float('nan'),
+            'batches': batches,
+        }
+        for stage, total in sorted(totals.items()):
+            row[f'{stage}_ms'] = 1000 * total / max(batches, 1)
+        new_file = not os.path.exists(self.csv_path)
+        with open(self.csv_path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(row))
+            if new_file:
+                writer.writeheader()
+            writer.writerow(row)
+        with self.writer.as_default():
+            for name, value in row.items():
+                if name != 'epoch' and not np.isnan(value):
+                    tf.summary.scalar(f'{pipeline_stats_name}/{name}', value, step=epoch)
+        self.writer.flush()
+
+    def on_train_end(self, logs=None):
+        if self.profile_steps is not None and self.profile_steps[0] <= self.global_step <= self.profile_steps[1]:
+            tf.profiler.experimental.stop()  # fit ended inside the traced range
+        if self.writer is not None:
+            self.writer.close()
@@ -33,28 +33,114 @@ def doScramble(X, key, flip, blockSize):
     return X
 
 
+def scrambleTables(key, flip, blockSize, shape):
+    # per output byte of a (h, w, c) image: flat source byte of its low and high nibble, shift moving that nibble
+    # into place and the combined xor mask of both bit flips, i.e. doScramble folded into one gather per nibble
+    assert (shape[0] % blockSize[0] == 0)
+    assert (shape[1] % blockSize[1] == 0)
+    assert (shape[2] == blockSize[2])
+    numBlock = (shape[0] // blockSize[0], shape[1] // blockSize[1])
+    numCh = blockSize[2]
+    d = blockSize[0] * blockSize[1] * numCh
+
+    def toBlocks(X):
+        X = np.reshape(X, (numBlock[0], blockSize[0], numBlock[1], blockSize[1], numCh))
+        X = np.transpose(X, (0, 2, 1, 3, 4))
+        return np.reshape(X, (numBlock[0], numBlock[1], d))
+
+    def fromBlocks(X):
+        X = np.broadcast_to(X, (numBlock[0], numBlock[1], d))
+        X = np.reshape(X, (numBlock[0], numBlock[1], blockSize[0], blockSize[1], numCh))
+        X = np.transpose(X, (0, 2, 1, 3, 4))
+        return np.ascontiguousarray(X).ravel()
+
+    key = np.asarray(key, dtype=np.intp)
+    flip = np.asarray(flip, dtype=bool)
+    blocks = toBlocks(np.arange(shape[0] * shape[1] * numCh))
+    srcByte = key % d
+    upper = key >= d  # nibble taken from the upper 4 bits of its source byte
+    flipped = flip[key] ^ flip
+    srcLo = fromBlocks(blocks[..., srcByte[:d]])
+    srcHi = fromBlocks(blocks[..., srcByte[d:]])
+    shiftLo = fromBlocks(np.where(upper[:d], 4, 0).astype(np.uint8))
+    shiftHi = fromBlocks(np.where(upper[d:], 0, 4).astype(np.uint8))
+    mask = fromBlocks((np.where(flipped[:d], 0x0F, 0) | np.where(flipped[d:], 0xF0, 0)).astype(np.uint8))
+    return srcLo, srcHi, shiftLo, shiftHi, mask
+
+
+class ScrambleKernel:
+    def __init__(self, key, flip, blockSize, shape):
+        self.shape = tuple(shape)
+        self.srcLo, self.srcHi, self.shiftLo, self.shiftHi, self.mask = scrambleTables(key, flip, blockSize, shape)
+
+    def __call__(self, X, out=None):
+        # a new array per call unless the caller passes a preallocated out, the kernel holds no per-call state
+        assert (X.dtype == np.uint8)
+        n = X.shape[0]
+        X = np.reshape(X, (n, -1))
+        lo = X[:, self.srcLo]
+        np.right_shift(lo, self.shiftLo, out=lo)
+        np.bitwise_and(lo, 0x0F, out=lo)
+        hi = X[:, self.srcHi]
+        np.left_shift(hi, self.shiftHi, out=hi)
+        np.bitwise_and(hi, 0xF0, out=hi)
+        np.bitwise_or(lo, hi, out=lo)
+        if out is None:
+            np.bitwise_xor(lo, self.mask, out=lo)
+            return np.reshape(lo, (n, *self.shape))
+        np.bitwise_xor(lo, self.mask, out=np.reshape(out, (n, -1)))
+        return out
+
+
 class BlockScramble:
-    def __init__(self, blockSize, seed):
-        self.blockSize = blockSize
-        key = self.genKey(seed)
-        self.key = key
-        self.rev = (key > key.size / 2)
-        self.invKey = np.argsort(key)
+    def __init__(self, blockSize, seed=None, key=None):
+        self.blockSize = tuple(blockSize)
+        if key is None:
+            key = self.genKey(seed)
+        self.key = np.asarray(key, dtype=np.uint32)
+        self.rev = (self.key > self.key.size / 2)
 
     def genKey(self, seed):
-        np.random.seed(seed)
+        # local RandomState, the same key as seeding the global one without touching it
         key = self.blockSize[0] * self.blockSize[1] * self.blockSize[2]
         key = np.arange(key * 2, dtype=np.uint32)
-        np.random.shuffle(key)
-        np.random.seed()
+        np.random.RandomState(seed).shuffle(key)
         return key
 
+    @property
+    def invKey(self):
+        return np.argsort(self.key)
+
+    def kernel(self, shape, inverse=False):
+        # kernels are rebuilt lazily and never pickled with the permutations
+        kernels = self.__dict__.setdefault('kernels', {})
+        shape = tuple(shape)
+        if (shape, inverse) not in kernels:
+            key = self.invKey if inverse else self.key
+            kernels[(shape, inverse)] = ScrambleKernel(key, self.rev, self.blockSize, shape)
+        return kernels[(shape, inverse)]
+
+    def ScrambleUint8(self, X, out=None):
+        return self.kernel(X.shape[1:])(X, out=out)
+
+    def DecrambleUint8(self, X, out=None):
+        return self.kernel(X.shape[1:], inverse=True)(X, out=out)
+
     def Scramble(self, X):
         XX = (X * 255).astype(np.uint8)
-        XX = doScramble(XX, self.key, self.rev, self.blockSize)
+        XX = self.ScrambleUint8(XX)
         return XX.astype('float32') / 255.0
 
     def Decramble(self, X):
         XX = (X * 255).astype(np.uint8)
-        XX = doScramble(XX, self.invKey, self.rev, self.blockSize)
+        XX = self.DecrambleUint8(XX)
         return XX.astype('float32') / 255.0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('kernels', None)
+        return state
+
+    def __setstate__(self, state):
+        state.pop('invKey', None)  # stored by older pickles
+        self.__dict__.update(state)
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import pathlib
+import weakref
+from os.path import join, exists
+
+import numpy as np
+
+from datasets import FoldView
+from permutation.BlockShuffle import BlockScramble
+from permutation.permutations import PatchExtractor
+
+PATCH_CACHE_DIR = 'cache/patches'
+PATCH_CACHE_BUDGET = 10 * 2 ** 30  # bytes
+CACHE_VERSION = 1
+BUILD_CHUNK = 1024  # images encrypted per step while filling an entry
+
+_fingerprints = {}  # id of a live array -> (weakref, fingerprint)
+
+
+def array_fingerprint(x):
+    # memoized per array object, the splits are never modified once loaded
+    memo = _fingerprints.get(id(x))
+    if memo is not None and memo[0]() is x:
+        return memo[1]
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(x, FoldView):  # the base is hashed once, a fold only adds its indices
+        h.update(f'fold{x.shape}{x.dtype}{array_fingerprint(x.base)}'.encode())
+        h.update(memoryview(x.indices))
+    else:
+        h.update(f'{x.shape}{x.dtype}'.encode())
+        for start in range(0, len(x), BUILD_CHUNK):
+            chunk = np.ascontiguousarray(x[start:start + BUILD_CHUNK])
+            h.update(memoryview(chunk.reshape(-1).view(np.uint8)))
+    key = id(x)
+    _fingerprints[key] = (weakref.ref(x, lambda _: _fingerprints.pop(key, None)), h.hexdigest())
+    return _fingerprints[key][1]
+
+
+def permutation_fingerprint(perm):
+    h = hashlib.blake2b(digest_size=16)
+    for p in perm:
+        if type(p) == BlockScramble:
+            h.update(f'bs{p.blockSize}'.encode())
+            h.update(np.ascontiguousarray(p.key, dtype=np.int64).tobytes())
+            h.update(np.ascontiguousarray(p.rev).tobytes())
+        else:
+            h.update(np.ascontiguousarray(p, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+class PatchCache:
+    # encrypted uint8 windows of a whole split, one memory-mapped .npy per (data, window, key)
+    def __init__(self, root=PATCH_CACHE_DIR, budget=PATCH_CACHE_BUDGET):
+        self.root = root
+        self.budget = budget
+
+    def entry_path(self, data_key, coords, perm, sub_input_shape):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f'{CACHE_VERSION}{data_key}{tuple(coords)}{tuple(sub_input_shape)}'.encode())
+        h.update(permutation_fingerprint(perm).encode())
+        return join(self.root, f'{h.hexdigest()}.npy')
+
+    def get_patches(self, x, permutations, sub_input_shape, data_key=None):
+        if data_key is None:
+            data_key = array_fingerprint(x)
+        pathlib.Path(self.root).mkdir(exist_ok=True, parents=True)
+        paths = {
+            coords: self.entry_path(data_key, coords, perm, sub_input_shape) for coords, perm in permutations.items()
+        }
+        while True:  # an entry evicted by another process between the build and the open is built again
+            missing = {coords: perm for coords, perm in permutations.items() if not exists(paths[coords])}
+            if missing:
+                print(f"Caching {len(missing)} encrypted windows of {len(x)} images...")
+                extractor = PatchExtractor(missing, sub_input_shape)
+                tmp_paths = [f'{paths[coords]}.{os.getpid()}.tmp' for coords in missing]
+                entries = [
+                    np.lib.format.open_memmap(p, mode='w+', dtype=np.uint8, shape=(len(x), *sub_input_shape))
+                    for p in tmp_paths
+                ]
+                for start in range(0, len(x), BUILD_CHUNK):
+                    chunk = np.asarray(x[start:start + BUILD_CHUNK], dtype=np.uint8)
+                    for entry, patches in zip(entries, extractor.extract(chunk)):
+                        entry[start:start + len(chunk)] = patches
+                for entry in entries:
+                    entry.flush()
+                del entries
+                for tmp_path, coords in zip(tmp_paths, missing):
+                    os.replace(tmp_path, paths[coords])
+                self.evict(keep=set(paths.values()))
+            patches = self.open_entries(paths[coords] for coords in permutations)
+            if patches is not None:
+                return patches
+
+    @staticmethod
+    def open_entries(paths):
+        entries = []
+        for path in paths:
+            try:
+                os.utime(path)  # recently used entries survive eviction
+                entries.append(np.load(path, mmap_mode='r'))
+            except FileNotFoundError:
+                return None
+        return entries
+
+    def evict(self, keep=()):
+        # other processes build and evict concurrently, any entry may disappear between listing and removal
+        entries = []
+        for f in os.listdir(self.root):
+            if f.endswith('.npy'):
+                try:
+                    stat = os.stat(join(self.root, f))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, join(self.root, f)))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.budget:
+                break
+            if path in keep:
+                continue
+            total -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -1,4 +1,5 @@
 import pathlib
+from functools import lru_cache
 from os.path import join
 
 import cv2
@@ -8,12 +9,13 @@ import numpy as np
 import tensorflow as tf
 from PIL import Image
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
-from sklearn.utils import shuffle
 
 from enums import Overlap, PermSchemas
-from permutation.BlockShuffle import BlockScramble
+from permutation.BlockShuffle import BlockScramble, scrambleTables
+from permutation.stage_timer import StageTimer
 
 MAX_SEED = 10000000
+KEY_CACHE_SIZE = 32  # key sets kept in memory, one per (seed, grid, sub-input shape, overlap, scheme)
 
 
 def cross(r, c, size=None, cntr=None):
@@ -27,20 +29,19 @@ def center(r, c, radius=None, cntr=None):
 
 def init_keys(seed, grid_shape, overlap_scheme, n_repeats):
     apply_base_grid = overlap_scheme.value[1]
-    if seed is not None:
-        np.random.seed(seed)
+    rng = np.random.RandomState(seed)  # the draws of the legacy global np.random.seed(seed)
     keys = {}
     if apply_base_grid:
         for r in range(grid_shape[0]):
             for c in range(grid_shape[1]):
                 if (r, c) not in keys:
-                    keys[(r, c)] = [np.random.randint(1, MAX_SEED) for _ in range(n_repeats)]
+                    keys[(r, c)] = [rng.randint(1, MAX_SEED) for _ in range(n_repeats)]
 
     def add_overlap(condition, **kwargs):
         for r in np.arange(0, grid_shape[0] - 0.5, 0.5):
             for c in np.arange(0, grid_shape[1] - 0.5, 0.5):
                 if (r, c) not in keys and condition(r, c, **kwargs):
-                    keys[(r, c)] = [np.random.randint(1, MAX_SEED) for _ in range(n_repeats)]
+                    keys[(r, c)] = [rng.randint(1, MAX_SEED) for _ in range(n_repeats)]
 
     if overlap_scheme == Overlap.CENTER:
         add_overlap(condition=center, radius=0.1, cntr=(grid_shape[0] / 2, grid_shape[1] / 2))
@@ -60,7 +61,6 @@ def init_keys(seed, grid_shape, overlap_scheme, n_repeats):
 
     else:  # no overlap
         pass
-    np.random.seed()  # restore randomness
     if seed is None:  # identity mode does not use seeds
         for key in keys:
             keys[key] = None
@@ -72,13 +72,24 @@ def generate_perm(shape, seed=None, blockSize=None):
         size = (blockSize[0], blockSize[1], shape[-1])
         return BlockScramble(size, seed)
 
-    indexes = np.arange(shape[0] * shape[1])
+    size = shape[0] * shape[1]
     if seed is None:  # identity
-        return indexes
-    return shuffle(indexes, random_state=seed)
+        return np.arange(size, dtype=index_dtype(size))
+    # sklearn's shuffle(np.arange(size), random_state=seed) without the copies
+    return np.random.RandomState(seed).permutation(size).astype(index_dtype(size))
+
+
+def index_dtype(size):
+    return np.uint16 if size <= np.iinfo(np.uint16).max + 1 else np.uint32
 
 
 def generate_permutations(seed, grid_shape, subinput_shape, overlap, scheme):
+    # memoized, the permutations of a key set are shared by all callers and must not be modified
+    return dict(cached_permutations(seed, tuple(grid_shape), tuple(subinput_shape), overlap, scheme))
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def cached_permutations(seed, grid_shape, subinput_shape, overlap, scheme):
     n_repeats = subinput_shape[-1] \
         if scheme in [PermSchemas.NAIVE, PermSchemas.IDENTITY] \
         else 1
@@ -99,6 +110,38 @@ def generate_permutations(seed, grid_shape, subinput_shape, overlap, scheme):
     return permutations
 
 
+def save_keys(path, permutations):
+    # the key tables of every window in the smallest index dtype, coordinates keep their int/float type
+    perms = list(permutations.values())
+    if type(perms[0][0]) == BlockScramble:
+        keys = np.stack([[p.key for p in perm] for perm in perms])
+        block_size = np.array(perms[0][0].blockSize)
+    else:
+        keys = np.stack([[np.asarray(p) for p in perm] for perm in perms])
+        block_size = np.zeros(0, dtype=int)
+    np.savez(
+        path,
+        coords=np.array(list(permutations), dtype=np.float64),
+        int_coords=np.array([[type(v) == int for v in coords] for coords in permutations]),
+        keys=keys.astype(index_dtype(keys.shape[-1])),
+        block_size=block_size,
+    )
+
+
+def load_keys(path):
+    with np.load(path) as f:
+        coords, int_coords, keys, block_size = f['coords'], f['int_coords'], f['keys'], f['block_size']
+    block_size = tuple(int(b) for b in block_size)
+    permutations = {}
+    for window, is_int, window_keys in zip(coords, int_coords, keys):
+        window = tuple(int(v) if i else np.float64(v) for v, i in zip(window, is_int))
+        if block_size:
+            permutations[window] = [BlockScramble(block_size, key=k) for k in window_keys]
+        else:
+            permutations[window] = list(window_keys)
+    return permutations
+
+
 def plot_hist(x, x_patch, x_enc, path, patch_id, enc_type):
     images = [x, x_patch, x_enc]
     fig, axs = plt.subplots(len(images), 4, figsize=[12, 12])
@@ -139,9 +182,22 @@ def plot_hist(x, x_patch, x_enc, path, patch_id, enc_type):
 
 class PermutationGenerator(tf.keras.utils.Sequence):
     def __init__(self, X, Y, augmenter, subinput_shape, shuffle_dataset=True, batch_size=None, permutations=None,
-                 examples_path=None):
+                 examples_path=None, seed=None, patches=None, uint8=False):
         self.n = len(X)
-        self.batch_gen = ImageDataGenerator().flow(X, Y, batch_size=batch_size, shuffle=shuffle_dataset)
+        self.uint8 = uint8  # batches of uint8 windows for models that rescale their inputs
+        if seed is None and uint8:
+            # keras' flow() casts batches to float32, index mode keeps the uint8 pixels
+            seed = np.random.randint(2 ** 31)
+        self.seed = seed
+        self.patches = patches  # precomputed uint8 windows of X, used instead of encrypting every batch
+        if seed is None:
+            self.batch_gen = ImageDataGenerator().flow(X, Y, batch_size=batch_size, shuffle=shuffle_dataset)
+        else:
+            # batch i of epoch e is a pure function of (i, e, seed), safe for keras workers
+            self.X, self.Y = X, Y
+            self.epoch = 0
+            self.step = 0
+            self.order = None
         self.augmenter = augmenter
         self.n_models = len(permutations)
         self.shuffle = shuffle_dataset
@@ -149,6 +205,8 @@ class PermutationGenerator(tf.keras.utils.Sequence):
         self.sub_input_shape = subinput_shape
         self.permutations = permutations
         self.examples_path = examples_path
+        self.extractor = PatchExtractor(permutations, subinput_shape)
+        self.timer = StageTimer()
 
     def run_histograms(self, xb):
         max_imgs = len(xb)
@@ -172,7 +230,7 @@ class PermutationGenerator(tf.keras.utils.Sequence):
     def generate_and_save_examples(self, borders=True):
         print("Generating examples...")
         scale = 15
-        xb, yb = self.batch_gen.next()
+        xb, yb = self.fetch(0)
         self.run_histograms(xb)
         xb = self.augment(xb)
         max_imgs = len(xb)
@@ -217,53 +275,243 @@ class PermutationGenerator(tf.keras.utils.Sequence):
                 img_path = join(self.examples_path, f'frames-{index + 1}.svg')
                 plt.imsave(img_path, imgs[0], format='svg')
 
-    def augment(self, x):
-        return np.array(
-            [self.augmenter(image=img.astype(np.uint8))['image'] / 255.0 for img in x]
-        ) if self.augmenter else x / 255.0
+    def augment(self, x, seeds=None):
+        # augmenter(x, seeds) maps a batch to uint8 images, one seed per image or None
+        if self.augmenter:
+            x = self.augmenter(x, seeds)
+        return x.astype(np.uint8, copy=False) if self.uint8 else x / 255.0
+
+    def batch_indices(self, index, epoch):
+        if not self.shuffle:
+            return np.arange(index * self.batch_size, min((index + 1) * self.batch_size, self.n))
+        order = self.order
+        if order is None or order[0] != epoch:
+            order = (epoch, np.random.default_rng([self.seed, epoch]).permutation(self.n))
+            self.order = order
+        return order[1][index * self.batch_size:(index + 1) * self.batch_size]
+
+    def augment_seeds(self, index, epoch, n):
+        # counter-based stream keyed by the generator seed, (batch, epoch) in the high counter words
+        rng = np.random.Generator(np.random.Philox(key=self.seed, counter=[0, 0, index, epoch]))
+        return rng.integers(0, 2 ** 32, n, dtype=np.uint32)
+
+    def fetch(self, index, epoch=None):
+        if self.seed is None:
+            return self.batch_gen.next()
+        indices = self.batch_indices(index, self.epoch if epoch is None else epoch)
+        return self.X[indices].astype(np.uint8 if self.uint8 else np.float32), self.Y[indices]
 
     def next(self):
-        x, y = self.batch_gen.next()
-        x = self.augment(x)
-        xp = self.generate_patches(x)
+        if self.seed is not None:
+            xp, y = self[self.step % len(self)]
+            self.step += 1
+            return xp, y
+        with self.timer.stage('fetch'):
+            x, y = self.batch_gen.next()
+        with self.timer.stage('augment'):
+            x = self.augment(x)
+        with self.timer.stage(self.patch_stage):
+            xp = self.generate_patches(x)
+        self.timer.batch_ready()
         return xp, y
 
     def on_epoch_end(self):
-        pass
+        if self.seed is not None:
+            self.epoch += 1
 
     def __getitem__(self, index):
-        return self.next()
+        if self.seed is None:
+            return self.next()
+        epoch = self.epoch
+        if self.patches is not None:
+            with self.timer.stage('fetch'):
+                indices = self.batch_indices(index, epoch)
+                if self.uint8:
+                    xp = [p[indices] for p in self.patches]
+                else:
+                    xp = [self.extractor.from_uint8(p[indices]) for p in self.patches]
+            self.timer.batch_ready()
+            return xp, self.Y[indices]
+        with self.timer.stage('fetch'):
+            x, y = self.fetch(index, epoch)
+        with self.timer.stage('augment'):
+            x = self.augment(x, self.augment_seeds(index, epoch, len(x)) if self.augmenter else None)
+        with self.timer.stage(self.patch_stage):
+            xp = self.generate_patches(x)
+        self.timer.batch_ready()
+        return xp, y
 
     def __len__(self):
         return self.n // self.batch_size
 
+    @property
+    def patch_stage(self):
+        # cropping and permuting or scrambling run as one gather, timed as a single stage
+        return 'scramble' if self.extractor.scrambled else 'permute'
+
     def generate_patches(self, x_batch):
-        sr, sc, _ = self.sub_input_shape
-        x_frames = []
-        for (row, col), perm in self.permutations.items():
-            # (row, col) is the position of top left corner of subinput window
-            xb = np.zeros((x_batch.shape[0], *self.sub_input_shape))
-            r_s = slice(int(row * sr), int((row + 1) * sr))
-            c_s = slice(int(col * sc), int((col + 1) * sc))
-            if type(perm[0]) == BlockScramble:
-                xb = permute(x_batch[:, r_s, c_s, :], perm[0])
-            else:
-                for i, x in enumerate(x_batch):
-                    sub_img = x[r_s, c_s, :]
-                    xb[i, ...] = permute(sub_img, perm)
-            x_frames.append(xb)
-        return x_frames  # shape = [batch, n_models, subwidth, subheight, channels]
+        if self.uint8:
+            return list(self.extractor.extract(x_batch))
+        return self.extractor(x_batch)  # shape = [n_models, batch, subwidth, subheight, channels]
+
+
+class PatchExtractor:
+    def __init__(self, permutations, sub_input_shape):
+        self.permutations = permutations
+        self.sub_input_shape = tuple(sub_input_shape)
+        self.scrambled = type(next(iter(permutations.values()))[0]) == BlockScramble
+        self.window_tables = {}
+
+    def crop_indices(self, image_shape, row, col):
+        # flat indices of the (row, col) window inside a (h, w, c) image, in window order
+        sr, sc, channels = self.sub_input_shape
+        _, width, _ = image_shape
+        rows = np.arange(int(row * sr), int(row * sr) + sr)
+        cols = np.arange(int(col * sc), int(col * sc) + sc)
+        pixels = rows[:, np.newaxis] * width + cols[np.newaxis, :]
+        return (pixels[..., np.newaxis] * channels + np.arange(channels)).ravel()
+
+    def get_window_tables(self, image_shape):
+        # crop offset and permutation of every window combined into gather tables over the whole image
+        window_tables = self.window_tables.get(image_shape)
+        if window_tables is None:
+            tables = []
+            for (row, col), perm in self.permutations.items():
+                crop = self.crop_indices(image_shape, row, col)
+                if self.scrambled:
+                    src_lo, src_hi, shift_lo, shift_hi, mask = scrambleTables(
+                        perm[0].key, perm[0].rev, perm[0].blockSize, self.sub_input_shape
+                    )
+                    tables.append((crop[src_lo], crop[src_hi], shift_lo, shift_hi, mask))
+                else:
+                    tables.append((crop[gather_indices(perm, self.sub_input_shape)],))
+            window_tables = [np.stack(t) for t in zip(*tables)]
+            self.window_tables[image_shape] = window_tables
+        return window_tables
+
+    def gather(self, x_flat, tables, out):
+        # one window of every row of a (n, h * w * c) batch, gathered with the window's own tables
+        if self.scrambled:
+            src_lo, src_hi, shift_lo, shift_hi, mask = tables
+            np.right_shift(x_flat[:, src_lo], shift_lo, out=out)
+            np.bitwise_and(out, 0x0F, out=out)
+            hi = x_flat[:, src_hi]
+            np.left_shift(hi, shift_hi, out=hi)
+            np.bitwise_and(hi, 0xF0, out=hi)
+            np.bitwise_or(out, hi, out=out)
+            np.bitwise_xor(out, mask, out=out)
+        else:
+            out[...] = x_flat[:, tables[0]]
+
+    def extract(self, x_batch):
+        # permuted windows in the dtype of x_batch, which must be uint8 for BlockScramble
+        n = len(x_batch)
+        image_shape = tuple(x_batch.shape[1:])
+        x_flat = np.reshape(x_batch, (n, -1))
+        patches = np.empty((len(self.permutations), n, int(np.prod(self.sub_input_shape))), dtype=x_batch.dtype)
+        for tables, out in zip(zip(*self.get_window_tables(image_shape)), patches):
+            self.gather(x_flat, tables, out)
+        return patches.reshape((len(self.permutations), n, *self.sub_input_shape))
+
+    def to_float(self, patches):
+        # dtype conversion of the original per-window permute(), float32 for BlockScramble, float64 otherwise
+        if self.scrambled:
+            return patches.astype('float32') / 255.0
+        return patches.astype(np.float64, copy=False)
+
+    def from_uint8(self, patches):
+        # same values and dtype as __call__ on the float32 batch scaled to [0, 1]
+        patches = patches.astype('float32') / 255.0
+        return patches if self.scrambled else patches.astype(np.float64)
+
+    def __call__(self, x_batch):
+        if self.scrambled:
+            x_batch = (x_batch * 255).astype(np.uint8)
+        return list(self.to_float(self.extract(x_batch)))
+
+    def tf_patches(self, x_batch, uint8=False):
+        # same windows as __call__ built from TF ops, for uint8 batches of a statically known image shape
+        tables = self.get_window_tables(tuple(x_batch.shape[1:]))
+        return tf_windows(x_batch, tables, self.scrambled, self.sub_input_shape, uint8)
+
+
+def tf_windows(x_batch, tables, scrambled, sub_input_shape, uint8=False):
+    image_size = int(np.prod(x_batch.shape[1:]))
+    x_flat = tf.reshape(x_batch, (-1, image_size))
+    if scrambled:
+        src_lo, src_hi, shift_lo, shift_hi, mask = tables
+        lo = tf.bitwise.right_shift(tf.gather(x_flat, src_lo, axis=1), tf.cast(shift_lo, tf.uint8))
+        hi = tf.bitwise.left_shift(tf.gather(x_flat, src_hi, axis=1), tf.cast(shift_hi, tf.uint8))
+        patches = tf.bitwise.bitwise_xor(
+            tf.bitwise.bitwise_or(tf.bitwise.bitwise_and(lo, 0x0F), tf.bitwise.bitwise_and(hi, 0xF0)),
+            tf.cast(mask, tf.uint8)
+        )
+    else:
+        patches = tf.gather(x_flat, tables[0], axis=1)
+    if not uint8:
+        patches = tf.cast(patches, tf.float32) / 255.0
+    return tuple(tf.reshape(p, (-1, *sub_input_shape)) for p in tf.unstack(patches, axis=1))
+
+
+@tf.keras.utils.register_keras_serializable(package='permutation')
+class PermutationLayer(tf.keras.layers.Layer):
+    # crops and permutes every window of whole uint8 images, the tables are stored as weights of the layer
+    def __init__(self, image_shape, sub_input_shape, n_windows, scrambled, uint8=False, **kwargs):
+        kwargs.pop('trainable', None)
+        super().__init__(trainable=False, **kwargs)
+        self.image_shape = tuple(image_shape)
+        self.sub_input_shape = tuple(sub_input_shape)
+        self.n_windows = n_windows
+        self.scrambled = scrambled
+        self.uint8 = uint8
+        size = int(np.prod(sub_input_shape))
+        names = ['src_lo', 'src_hi', 'shift_lo', 'shift_hi', 'mask'] if scrambled else ['indices']
+        self.tables = [
+            self.add_weight(name=name, shape=(n_windows, size), dtype=tf.int32, initializer='zeros', trainable=False)
+            for name in names
+        ]
+
+    @classmethod
+    def from_permutations(cls, permutations, sub_input_shape, image_shape, uint8=False, **kwargs):
+        extractor = PatchExtractor(permutations, sub_input_shape)
+        layer = cls(image_shape, sub_input_shape, len(permutations), extractor.scrambled, uint8, **kwargs)
+        for table, values in zip(layer.tables, extractor.get_window_tables(tuple(image_shape))):
+            table.assign(values.astype(np.int32))
+        return layer
+
+    def call(self, inputs):
+        return tf_windows(tf.cast(inputs, tf.uint8), self.tables, self.scrambled, self.sub_input_shape, self.uint8)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            'image_shape': self.image_shape,
+            'sub_input_shape': self.sub_input_shape,
+            'n_windows': self.n_windows,
+            'scrambled': self.scrambled,
+            'uint8': self.uint8,
+        })
+        return config
+
+
+def gather_indices(perm, shape):
+    # flat (pixel, channel) index table equivalent to applying perm[c] to every channel c of a (h, w, c) image
+    channels = shape[-1]
+    perm = np.asarray(perm, dtype=np.intp).reshape(channels, -1)
+    return (perm.T * channels + np.arange(channels)).ravel()
+
+
+def permute_batch(x_batch, indices):
+    x_flat = x_batch.reshape(x_batch.shape[0], -1)
+    res = x_flat[:, indices].astype(np.float64, copy=False)
+    return res.reshape(x_batch.shape)
 
 
 def permute(arr, perm):
     if type(perm) == BlockScramble:
         return perm.Scramble(arr)
 
-    res = np.zeros(arr.shape)
-    for c in range(arr.shape[-1]):
-        channel = arr[:, :, c]
-        res[:, :, c] = channel.ravel()[perm[c]].reshape(channel.shape)
-    return res
+    return permute_batch(arr[np.newaxis, ...], gather_indices(perm, arr.shape))[0]
 
 
 def pad_around(img, dims=None):
@@ -0,0 +1,49 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class StageTimer:
+    # wall time of the stages of batch generation, summed until reset, and the times batches became ready
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.batches = 0
+        self.ready = deque()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0) + elapsed
+
+    def batch_ready(self):
+        with self.lock:
+            self.batches += 1
+            self.ready.append(time.perf_counter())
+
+    def pop_ready(self):
+        with self.lock:
+            return self.ready.popleft() if self.ready else None
+
+    def reset(self, clear_ready=False):
+        # batches prefetched for the next epoch stay ready unless cleared
+        with self.lock:
+            totals, batches = self.totals, self.batches
+            self.totals, self.batches = {}, 0
+            if clear_ready:
+                self.ready.clear()
+        return totals, batches
+
+    def __getstate__(self):
+        # copies in keras worker processes time batches nobody reads
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
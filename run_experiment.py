@@ -1,12 +1,11 @@
 import gc
+import multiprocessing as mp
 import os
-import shutil
-
-from enums import Overlap
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # suppress logging
 import pathlib
 import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from contextlib import redirect_stdout
 from copy import copy
 from pprint import pprint
@@ -14,18 +13,26 @@ from pprint import pprint
 import numpy as np
 from scipy.stats import ttest_rel
 from sklearn.model_selection import RepeatedStratifiedKFold
+from tensorflow.keras.models import load_model
 from tensorflow.python.client import device_lib
 from tabulate import tabulate
 
-from datasets import load_data, get_classes_names_for_dataset
+from datasets import load_data, get_classes_names_for_dataset, FoldView
 from experiment_configs import get_experiment
-from model.training import train_model, predict, skip_training
+from model.model_store import ModelStore, fold_fingerprint
+from model.train_configs import SUB_INTER_THREADS
+from model.training import train_model, train_sub_model, predict, skip_training, set_tf_threads
 from permutation.permutations import generate_permutations
+from scheduler import Scheduler, Job
 
 print(device_lib.list_local_devices())
 
 experiment_name = 'exp-3'
 
+JOB_WORKERS = 1  # jobs of the experiment graph run concurrently, each in its own process when > 1
+EVAL_WORKERS = 1  # (config, fold) cells scored concurrently by evaluate_models
+EVALUATE_ONLY = False  # re-score the trained models of the experiment instead of running the job graph
+
 N_REPEATS = 5
 N_SPLITS = 2
 kfold = RepeatedStratifiedKFold(n_splits=N_SPLITS, n_repeats=N_REPEATS, random_state=42)
@@ -41,24 +48,6 @@ ds = [
 ]
 
 
-def reuse_trained_models(model_path, overlap):
-    source_path = model_path.replace('ov_' + overlap.name.lower(), 'ov_' + Overlap.FULL.name.lower())
-    if os.path.exists(source_path) and source_path != model_path:
-        if overlap == Overlap.CENTER:
-            n_models = 5
-        elif overlap == Overlap.NONE:
-            n_models = 4
-        else:
-            return
-        for i in range(n_models):
-            sub_source_path = os.path.join(source_path, 'subs', str(i))
-            target_path = os.path.join(model_path, 'subs', str(i))
-            if os.path.exists(target_path):
-                continue
-            print(f"Reusing model {sub_source_path}")
-            shutil.copytree(sub_source_path, target_path)
-
-
 def get_path_from_config(model_params, ds_name, f_id):
     mode = model_params['type']
     grid_size = model_params['grid_size']
@@ -92,74 +81,142 @@ def parse_config(model_params, ds_name, f_id, n_classes, input_shape):
     model_path = get_path_from_config(model_params, ds_name, f_id)
 
     classes = get_classes_names_for_dataset(ds_name)
-    reuse_trained_models(model_path, overlap)
     print(
         f"Running with ({mode}, {arch.name.lower()}, {scheme.name.lower()}, {aggr_scheme.name.lower()},"
         f" {overlap.name.lower()})")
     return (model_path, permutations, sub_input_shape, n_classes, ds_name, arch, mode, aggr_scheme), classes
 
 
-def train_models(data, models):
+def fold_views(x, y, train, valid):
+    return FoldView(x, train), FoldView(y, train), FoldView(x, valid), FoldView(y, valid)
+
+
+def train_sub_job(ds_name, m_config, f_id, train, valid, i, entry_path):
+    (x, y), _, n_classes = load_data(ds_name, split='train')
+    params, _ = parse_config(m_config, ds_name, f_id, n_classes, x.shape[1:])
+    _, permutations, sub_input_shape, n_classes, ds_name, arch = params[:6]
+    if not skip_training(entry_path):
+        sub_perm = dict([list(permutations.items())[i]])
+        train_sub_model(*fold_views(x, y, train, valid), entry_path, sub_perm, sub_input_shape, n_classes,
+                        ds_name, arch, m_id=i)
+
+
+def train_job(ds_name, m_config, f_id, train, valid):
+    (x, y), _, n_classes = load_data(ds_name, split='train')
+    params, _ = parse_config(m_config, ds_name, f_id, n_classes, x.shape[1:])
+    if not skip_training(params[0]):
+        train_model(*fold_views(x, y, train, valid), *params)
+
+
+def evaluate_job(ds_name, m_config, f_id, run_faulty_test=True):
+    _, (x_test, y_test), n_classes = load_data(ds_name, split='test')
+    params, classes_names = parse_config(m_config, ds_name, f_id, n_classes, x_test.shape[1:])
+    model_path = params[0]
+    model = load_model(model_path)  # shared by both tests
+    if run_faulty_test:
+        print("Running test with invalid key")
+        invalid_test_config = copy(m_config)
+        invalid_test_config['seed'] = 1111
+        acc = predict(
+            model_path, x_test, y_test, params[2], classes_names,
+            invalid_test=invalid_test_config,
+            test_dir_name='test_invalid_perm',
+            model=model
+        )
+        print("False Accuracy: ", acc)
+    acc = predict(model_path, x_test, y_test, params[2], classes_names, mode=params[6], model=model)
+    print("Accuracy: ", acc)
+    np.save(os.path.join(model_path, 'test', 'score.npy'), acc)
+    return acc
+
+
+def stats_job(data, models, exp_dir):
+    scores = np.zeros((len(data), len(models), kfold.get_n_splits()))
     for d_id, ds_name in enumerate(data):
-        (x, y), _, n_classes = load_data(ds_name)
-        y_s = np.argmax(y, axis=1) if n_classes != 2 else y
         for m_id, m_config in enumerate(models):
-            for f_id, (train, valid) in enumerate(kfold.split(x, y_s)):
-                params, _ = parse_config(m_config, ds_name, f_id, n_classes, x.shape[1:])
-                print(f'{m_id=} , {f_id=}')
-                model_path = params[0]
-                if not skip_training(model_path):
-                    train_model(x[train], y[train], x[valid], y[valid], *params)
-
-
-def evaluate_models(data, models, scores_path, run_faulty_test=True):
-    configs = [[[None for _ in range(kfold.get_n_splits())] for _ in range(len(models))] for _ in range(len(data))]
+            for f_id in range(kfold.get_n_splits()):
+                model_path = get_path_from_config(m_config, ds_name, f_id)
+                scores[d_id, m_id, f_id] = np.load(os.path.join(model_path, 'test', 'score.npy'))
+    save_scores(scores, data, models, exp_dir)
+
+
+def save_scores(scores, data, models, exp_dir):
+    configs = [[[m_config for _ in range(kfold.get_n_splits())] for m_config in models] for _ in data]
+    with open(f'{exp_dir}/scores', 'wb') as file:
+        pickle.dump({'configs': configs, 'scores': scores}, file)
+    run_stats(scores, exp_dir, models)
+
+
+def evaluate_models(data, models, exp_dir, n_workers=EVAL_WORKERS):
+    # every trained (config, fold) cell scored in its own process, the test split is a memory-mapped cache
+    # built here once, so the workers share its pages instead of loading copies
+    for ds_name in data:
+        load_data(ds_name, split='test')
+    cells = [
+        ((d_id, m_id, f_id), (ds_name, m_config, f_id))
+        for d_id, ds_name in enumerate(data)
+        for m_id, m_config in enumerate(models)
+        for f_id in range(kfold.get_n_splits())
+    ]
     scores = np.zeros((len(data), len(models), kfold.get_n_splits()))
-    for d_id, ds_name in enumerate(data):
-        _, (x_test, y_test), n_classes = load_data(ds_name)
-        for f_id in range(kfold.get_n_splits()):
-            for m_id, m_config in enumerate(models):
-                params, classes_names = parse_config(m_config, ds_name, f_id, n_classes, x_test.shape[1:])
-                model_path = params[0]
-                if run_faulty_test:
-                    print("Running test with invalid key")
-                    invalid_test_config = copy(m_config)
-                    invalid_test_config['seed'] = 1111
-                    acc = predict(
-                        model_path, x_test, y_test, params[2], classes_names,
-                        invalid_test=invalid_test_config,
-                        test_dir_name='test_invalid_perm'
-                    )
-                    print("False Accuracy: ", acc)
-                acc = predict(model_path, x_test, y_test, params[2], classes_names, mode=params[6])
-                print("Accuracy: ", acc)
-                scores[d_id, m_id, f_id] = acc
-                configs[d_id][m_id][f_id] = m_config
-    result = {
-        'configs': configs,
-        'scores': scores
-    }
-    with open(scores_path, 'wb') as file:
-        pickle.dump(result, file)
-    return result
+    if n_workers <= 1:
+        for cell, args in cells:
+            scores[cell] = evaluate_job(*args)
+    else:
+        intra_threads = max(1, os.cpu_count() // n_workers)
+        with ProcessPoolExecutor(n_workers, mp_context=mp.get_context('spawn'), initializer=set_tf_threads,
+                                 initargs=(intra_threads, SUB_INTER_THREADS)) as pool:
+            futures = {pool.submit(evaluate_job, *args): cell for cell, args in cells}
+            for future in as_completed(futures):
+                scores[futures[future]] = future.result()
+    save_scores(scores, data, models, exp_dir)
+    return scores
+
+
+def add_jobs(scheduler, data, models, exp_dir):
+    # sub-models -> model -> evaluation of each (dataset, config, fold), then the stats of the whole experiment
+    eval_jobs = []
+    store = ModelStore()
+    for ds_name in data:
+        (x, y), _, n_classes = load_data(ds_name, split='train')
+        y_s = np.argmax(y, axis=1) if n_classes != 2 else y
+        for f_id, (train, valid) in enumerate(kfold.split(np.zeros(len(y_s)), y_s)):
+            data_key = None
+            for m_config in models:
+                params, _ = parse_config(m_config, ds_name, f_id, n_classes, x.shape[1:])
+                model_path, permutations, sub_input_shape, _, _, arch = params[:6]
+                sub_jobs = []
+                if m_config['type'] == 'composite':
+                    # one job per store entry, configs sharing a window and key wait for the same sub-model
+                    if data_key is None:
+                        data_key = fold_fingerprint(*fold_views(x, y, train, valid))
+                    for i, (coords, perm) in enumerate(permutations.items()):
+                        if os.path.exists(os.path.join(model_path, 'subs', str(i), 'saved_model.pb')):
+                            continue
+                        entry_path = store.entry_path(data_key, arch, n_classes, sub_input_shape, coords, perm)
+                        sub_args = (ds_name, m_config, f_id, train, valid, i, entry_path)
+                        sub_jobs.append(scheduler.add(Job(f'train:{entry_path}', train_sub_job, sub_args)))
+                train_name = scheduler.add(
+                    Job(f'train:{model_path}', train_job, (ds_name, m_config, f_id, train, valid), deps=sub_jobs)
+                )
+                eval_jobs.append(scheduler.add(
+                    Job(f'evaluate:{model_path}', evaluate_job, (ds_name, m_config, f_id), deps=[train_name])
+                ))
+    scheduler.add(Job(f'stats:{exp_dir}', stats_job, (data, models, exp_dir), deps=eval_jobs))
 
 
 def run_tests(data):
     exp_dir = f'experiments/{experiment_name}'
-    scores_path = f'{exp_dir}/scores'
     pathlib.Path(exp_dir).mkdir(exist_ok=True, parents=True)
     models_params = get_experiment()
     with open(f'{exp_dir}/experiment_config', 'w') as conf:
         pprint(models_params, conf)
 
-    train_models(data, models_params)
-
-    if not os.path.exists(scores_path):
-        results = evaluate_models(data, models_params, scores_path)
-    else:
-        with open(scores_path, 'rb') as file:
-            results = pickle.load(file)
-    run_stats(results['scores'], exp_dir, models_params)
+    intra_threads = max(1, os.cpu_count() // JOB_WORKERS)
+    scheduler = Scheduler(f'{exp_dir}/jobs.json', JOB_WORKERS, initializer=set_tf_threads,
+                          initargs=(intra_threads, SUB_INTER_THREADS))
+    add_jobs(scheduler, data, models_params, exp_dir)
+    scheduler.run()
 
 
 def run_stats(scores, exp_dir, models_params, alfa=0.05):
@@ -228,4 +285,7 @@ def print_pretty_table(t_statistic, p_value, advantage_table, save_path, headers
 
 
 if __name__ == '__main__':
-    run_tests(ds)
+    if EVALUATE_ONLY:
+        evaluate_models(ds, get_experiment(), f'experiments/{experiment_name}')
+    else:
+        run_tests(ds)
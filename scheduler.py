@@ -0,0 +1,98 @@
+import json
+import multiprocessing as mp
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job:
+    def __init__(self, name, fn, args=(), deps=()):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.deps = list(deps)
+
+
+class Scheduler:
+    # dependency graph of jobs run on a bounded process pool, finished jobs are recorded in state_path
+    def __init__(self, state_path, n_workers=1, initializer=None, initargs=()):
+        self.state_path = state_path
+        self.n_workers = n_workers
+        self.initializer = initializer
+        self.initargs = initargs
+        self.jobs = {}
+        self.state = {}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+
+    def add(self, job):
+        if job.name not in self.jobs:  # jobs shared by several configs are added once
+            self.jobs[job.name] = job
+        return job.name
+
+    def save_state(self):
+        tmp_path = f'{self.state_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def finish(self, name, error=None):
+        if error is None:
+            self.state[name] = DONE
+        else:
+            self.state[name] = FAILED
+            print(f"Job {name} failed:\n{error}")
+        self.save_state()
+
+    def ready(self, running):
+        return [
+            job for name, job in self.jobs.items()
+            if self.state.get(name, PENDING) == PENDING and name not in running
+            and all(self.state.get(dep) == DONE for dep in job.deps)
+        ]
+
+    def run(self):
+        # failed jobs are retried on the next run, their dependents wait for them
+        for name, s in list(self.state.items()):
+            if s == FAILED:
+                self.state[name] = PENDING
+        if self.n_workers <= 1:
+            return self.run_inline()
+        running = {}
+        with ProcessPoolExecutor(self.n_workers, mp_context=mp.get_context('spawn'), initializer=self.initializer,
+                                 initargs=self.initargs) as pool:
+            while True:
+                for job in self.ready(running.values())[:self.n_workers - len(running)]:
+                    running[pool.submit(job.fn, *job.args)] = job.name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    error = future.exception()
+                    self.finish(name, None if error is None else ''.join(traceback.format_exception(error)))
+        return self.summary()
+
+    def run_inline(self):
+        while True:
+            jobs = self.ready(())
+            if not jobs:
+                break
+            job = jobs[0]
+            try:
+                job.fn(*job.args)
+                self.finish(job.name)
+            except Exception:
+                self.finish(job.name, traceback.format_exc())
+        return self.summary()
+
+    def summary(self):
+        states = [self.state.get(name, PENDING) for name in self.jobs]
+        counts = {s: states.count(s) for s in (DONE, FAILED, PENDING)}
+        print(f"Jobs: {counts[DONE]} done, {counts[FAILED]} failed, {counts[PENDING]} blocked")
+        return counts[FAILED] == 0 and counts[PENDING] == 0
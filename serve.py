@@ -0,0 +1,214 @@
+import argparse
+import io
+import json
+import os
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # suppress logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join, exists
+from urllib.request import Request, urlopen
+
+import numpy as np
+from tensorflow.keras.models import load_model
+
+from model.training import export_serving_model
+from model.utils import serving_dir_name
+
+SERVE_HOST = '127.0.0.1'
+SERVE_PORT = 8500
+MAX_BATCH = 64
+MAX_LATENCY_MS = 5  # the first request of a batch waits at most this long for others to join
+LATENCY_WINDOW = 10000  # requests kept for the percentiles
+
+
+def load_serving_model(model_path, image_shape=None):
+    # the exported model with the permutations in the graph, exported from the composite if missing
+    serving_path = join(model_path, serving_dir_name)
+    if exists(serving_path):
+        return load_model(serving_path, compile=False)
+    if image_shape is None:
+        raise ValueError(f"{serving_path} does not exist, the image shape is needed to export it")
+    return export_serving_model(model_path, tuple(image_shape))
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.requests = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, latencies):
+        with self.lock:
+            self.requests += len(latencies)
+            self.batches += 1
+            self.latencies.extend(latencies)
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.start
+            latencies = np.array(self.latencies) * 1000
+            return {
+                'requests': self.requests,
+                'batches': self.batches,
+                'mean_batch': self.requests / max(self.batches, 1),
+                'images/sec': self.requests / elapsed,
+                'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            }
+
+
+class DynamicBatcher:
+    # single-image requests coalesced into batches of up to max_batch, one inference thread
+    def __init__(self, model, max_batch=MAX_BATCH, max_latency_ms=MAX_LATENCY_MS):
+        self.model = model
+        self.image_shape = tuple(model.input_shape[1:])
+        self.max_batch = max_batch
+        self.max_latency = max_latency_ms / 1000
+        self.queue = queue.Queue()
+        self.stats = Stats()
+        self.model.predict_on_batch(np.zeros((1, *self.image_shape), dtype=np.uint8))  # warm up
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, image):
+        image = np.asarray(image, dtype=np.uint8)
+        if image.shape != self.image_shape:
+            raise ValueError(f"Expected an image of shape {self.image_shape}, got {image.shape}")
+        future = Future()
+        self.queue.put((image, time.perf_counter(), future))
+        return future
+
+    def next_batch(self):
+        requests = [self.queue.get()]
+        deadline = requests[0][1] + self.max_latency
+        while len(requests) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                requests.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return requests
+
+    def loop(self):
+        while True:
+            requests = self.next_batch()
+            try:
+                probs = np.asarray(self.model.predict_on_batch(np.stack([r[0] for r in requests])))
+            except Exception as e:
+                for _, _, future in requests:
+                    future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            for (_, _, future), p in zip(requests, probs):
+                future.set_result(p)
+            self.stats.record([end - r[1] for r in requests])
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    # POST /predict with an .npy encoded uint8 image, GET /stats
+    batcher = None
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.batcher.stats.summary())
+        else:
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            length = self.headers['Content-Length']
+            if length is None or int(length) < 0:
+                raise ValueError(f"Expected a Content-Length, got {length}")
+            body = self.rfile.read(int(length))
+            future = self.batcher.submit(np.load(io.BytesIO(body), allow_pickle=False))
+        except (ValueError, EOFError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        try:
+            probs = future.result()
+        except Exception as e:  # raised by the model for the whole batch
+            self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+            return
+        self.send_json(200, {'probabilities': probs.tolist()})
+
+    def log_message(self, *args):
+        pass
+
+
+def make_server(model, host=SERVE_HOST, port=SERVE_PORT, max_batch=MAX_BATCH, max_latency_ms=MAX_LATENCY_MS):
+    handler = type('Handler', (InferenceHandler,), {'batcher': DynamicBatcher(model, max_batch, max_latency_ms)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def encode_image(image):
+    buf = io.BytesIO()
+    np.save(buf, np.asarray(image, dtype=np.uint8), allow_pickle=False)
+    return buf.getvalue()
+
+
+def request_prediction(url, image):
+    with urlopen(Request(f'{url}/predict', data=encode_image(image),
+                         headers={'Content-Type': 'application/octet-stream'})) as r:
+        return np.array(json.loads(r.read())['probabilities'])
+
+
+def server_stats(url):
+    with urlopen(f'{url}/stats') as r:
+        return json.loads(r.read())
+
+
+def generate_load(url, images, n_requests=1000, concurrency=32):
+    # closed loop, each of the concurrency clients sends its next image once the previous one is answered
+    def send(i):
+        start = time.perf_counter()
+        probs = request_prediction(url, images[i % len(images)])
+        return i, probs, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(send, range(n_requests)))
+    elapsed = time.perf_counter() - start
+    latencies = np.array([r[2] for r in results]) * 1000
+    return {
+        'requests': n_requests,
+        'concurrency': concurrency,
+        'images/sec': n_requests / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'probabilities': np.stack([r[1] for r in sorted(results, key=lambda r: r[0])]),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='dynamic-batching inference server for a trained composite')
+    parser.add_argument('model_path')
+    parser.add_argument('--image-shape', type=int, nargs=3, help='needed when the serving model is not exported yet')
+    parser.add_argument('--host', default=SERVE_HOST)
+    parser.add_argument('--port', type=int, default=SERVE_PORT)
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--max-latency-ms', type=float, default=MAX_LATENCY_MS)
+    args = parser.parse_args()
+    server = make_server(load_serving_model(args.model_path, args.image_shape), args.host, args.port,
+                         args.max_batch, args.max_latency_ms)
+    print(f"Serving {args.model_path} on http://{args.host}:{args.port}")
+    server.serve_forever()
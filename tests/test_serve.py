@@ -0,0 +1,73 @@
+import http.client
+import threading
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+
+import numpy as np
+import pytest
+
+from serve import make_server, request_prediction, generate_load, server_stats
+
+IMAGE_SHAPE = (4, 4, 3)
+
+
+class StubModel:
+    # mean pixel of every image as a two-class probability, batches holding an all-white image fail
+    input_shape = (None, *IMAGE_SHAPE)
+
+    def predict_on_batch(self, x):
+        if (x == 255).all(axis=(1, 2, 3)).any():
+            raise RuntimeError('bad batch')
+        p = x.mean(axis=(1, 2, 3)) / 255
+        return np.stack([p, 1 - p], axis=1)
+
+
+@pytest.fixture
+def url():
+    server = make_server(StubModel(), port=0, max_latency_ms=1)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def images(n, fill=None):
+    x = np.random.default_rng(0).integers(0, 255, (n, *IMAGE_SHAPE), dtype=np.uint8)
+    if fill is not None:
+        x[:] = fill
+    return x
+
+
+def test_predictions(url):
+    x = images(8)
+    result = generate_load(url, x, n_requests=16, concurrency=4)
+    p = x.mean(axis=(1, 2, 3)) / 255
+    np.testing.assert_allclose(result['probabilities'][:8, 0], p)
+    np.testing.assert_allclose(result['probabilities'][8:, 0], p)
+    assert server_stats(url)['requests'] == 16
+
+
+def test_model_error(url):
+    with pytest.raises(HTTPError) as e:
+        request_prediction(url, images(1, fill=255)[0])
+    assert e.value.code == 500
+    assert 'bad batch' in e.value.read().decode()
+    with pytest.raises(HTTPError) as e:
+        generate_load(url, images(4, fill=255), n_requests=8, concurrency=4)
+    assert e.value.code == 500
+    np.testing.assert_allclose(request_prediction(url, images(1)[0])[0], images(1)[0].mean() / 255)  # still serving
+
+
+def test_bad_request(url):
+    with pytest.raises(HTTPError) as e:
+        request_prediction(url, np.zeros((2, 2, 3), dtype=np.uint8))
+    assert e.value.code == 400
+    address = urlparse(url)
+    conn = http.client.HTTPConnection(address.hostname, address.port)
+    conn.putrequest('POST', '/predict')  # no Content-Length
+    conn.endheaders()
+    response = conn.getresponse()
+    assert response.status == 400
+    assert 'Content-Length' in response.read().decode()
+    conn.close()